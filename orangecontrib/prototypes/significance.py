@@ -1,17 +1,28 @@
+import os
 import sys
-from contextlib import contextmanager
-from typing import Tuple, Sequence
+import hashlib
+import tempfile
+import multiprocessing
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, partial
+from multiprocessing import shared_memory
+from typing import Tuple
 
 import numpy as np
 import pandas as pd
-from pandas.api.types import is_numeric_dtype, is_object_dtype
+import scipy.sparse as sp
+from pandas.api.types import is_bool_dtype, is_numeric_dtype, is_object_dtype
 
+from scipy.special import ndtri
 from scipy.stats import (
-    hypergeom, chisquare, ttest_1samp, fligner,
-    mannwhitneyu, gumbel_l, gumbel_r,
+    hypergeom, chi2, norm, t as student_t, rankdata,
+    gumbel_l, gumbel_r,
 )
 
-from joblib import Parallel, delayed
+from joblib import effective_n_jobs
 
 
 @contextmanager
@@ -32,9 +43,80 @@ COLUMN_RENAMES = {
 }
 
 
+class Cancelled(Exception):
+    """Raised by a computation whose cancellation token was cancelled"""
+
+
+class CancellationToken:
+    """
+    Token for cooperative cancellation of tests. Computations check it
+    between batches of work and raise Cancelled when it is set. Any
+    object with a boolean `cancelled` attribute can serve as a token.
+    """
+    cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def _check_cancelled(token):
+    if token is not None and token.cancelled:
+        raise Cancelled
+
+
+class _GroupKeys:
+    """
+    Groups of rows with equal values in all columns of X.
+
+    Each column is factorized and the codes are combined in mixed radix
+    into a single int64 key. If the product of cardinalities would
+    overflow, the partial key is first compacted to a dense code with a
+    hash table. Keys are then compacted to group codes 0..n_groups - 1,
+    which are ordered lexicographically by the values, like sorted tuples.
+    Labels (tuples of values) are decoded only on request.
+    """
+    MAX_KEY = np.iinfo(np.int64).max
+
+    def __init__(self, X: pd.DataFrame):
+        self.name = tuple(X.columns)
+        # Decoding steps: (radix, uniques) per column or (None, keys) per compaction
+        self._steps = []
+        key, size = np.zeros(len(X), dtype=np.int64), 1
+        for col in X.columns:
+            codes, uniques = pd.factorize(X[col].values, sort=True)
+            radix = max(len(uniques), 1)
+            if size * radix > self.MAX_KEY:
+                key, compacted = pd.factorize(key, sort=True)
+                self._steps.append((None, compacted))
+                size = len(compacted)
+            key = key * radix + codes
+            size *= radix
+            self._steps.append((radix, np.asarray(uniques)))
+
+        if size <= max(len(key), 1024):
+            present = np.bincount(key, minlength=size) > 0
+            self.codes = (np.cumsum(present) - 1)[key]
+            self._keys = np.flatnonzero(present)
+        else:
+            self.codes, self._keys = pd.factorize(key, sort=True)
+        self.n_groups = len(self._keys)
+
+    def labels(self, groups=None):
+        """Tuples of column values of the given (or all) groups"""
+        keys = self._keys if groups is None else self._keys[groups]
+        columns = []
+        for radix, uniques in reversed(self._steps):
+            if radix is None:
+                keys = uniques[keys]
+            else:
+                columns.append(uniques[keys % radix])
+                keys = keys // radix
+        return list(zip(*reversed(columns)))
+
+
 def _check_Xy(X: pd.DataFrame,
               y: pd.Series, *,
-              norm_y=False) -> Tuple[pd.Series, pd.Series]:
+              norm_y=False) -> Tuple[_GroupKeys, pd.Series]:
     if np.ndim(X) == 1:
         X = pd.Series(X).to_frame()
     elif np.ndim(X) == 2:
@@ -44,11 +126,12 @@ def _check_Xy(X: pd.DataFrame,
     assert np.ndim(y) == 1
     assert len(X) == len(y)
 
-    valid = ~X.isnull().any(1).values
-    X = pd.Series(list(zip(*X.values[valid].T)),
-                  name=tuple(X.columns)).astype('category')
-    y = pd.Series(y).reset_index(drop=True)[valid]
+    y = pd.Series(y).reset_index(drop=True)
+    valid = ~(X.isnull().any(axis=1).values | y.isnull().values)
+    return _GroupKeys(X[valid]), _check_y(y[valid], norm_y=norm_y)
+
 
+def _check_y(y: pd.Series, *, norm_y=False):
     if is_object_dtype(y):
         y = pd.Categorical(y)
 
@@ -56,217 +139,1504 @@ def _check_Xy(X: pd.DataFrame,
         assert is_numeric_dtype(y)
         y = (y - y.mean()) / y.std()
 
-    return X, y
+    return y
 
 
-# This is class so that it's picklable for joblib
-class _PermTestChi2:
-    def __init__(self, values):
-        self.f_exp = values.value_counts()
+def _reduce_segments(ufunc, values, bounds):
+    """Reduce each segment values[bounds[i]:bounds[i + 1]] with ufunc;
+    NaN for empty segments"""
+    result = np.full(bounds.size - 1, np.nan)
+    nonempty = np.flatnonzero(np.diff(bounds))
+    if nonempty.size:
+        # Empty segments are skipped, so each reduction ends at the next start
+        result[nonempty] = ufunc.reduceat(values, bounds[nonempty])
+    return result
 
-    def __call__(self, values):
-        f_obs = pd.Series(values).value_counts().reindex(self.f_exp.index).fillna(0)
-        return chisquare(f_obs.values, self.f_exp.values)[0]
 
+# Permutation test statistics are classes so that they're picklable for joblib.
+# Each is computed row-wise over a 2-D array holding one sample per row.
+class _PermTestStatistic(ABC):
+    @abstractmethod
+    def __call__(self, samples):
+        pass
+
+    def prefix(self, samples, sizes):
+        """Statistic of the first n items of each row, for n in sizes"""
+        return np.column_stack([self(samples[:, :n]) for n in sizes])
+
+    def segments(self, values, bounds):
+        """Statistic of each segment values[bounds[i]:bounds[i + 1]], e.g. of
+        groups of values sorted by group; NaN for empty segments"""
+        result = np.full(bounds.size - 1, np.nan)
+        for i in np.flatnonzero(np.diff(bounds)):
+            result[i] = self(values[np.newaxis, bounds[i]:bounds[i + 1]])[0]
+        return result
+
+
+class _PermTestMean(_PermTestStatistic):
+    def __call__(self, samples):
+        return samples.mean(axis=1)
+
+    def prefix(self, samples, sizes):
+        return np.cumsum(samples, axis=1)[:, sizes - 1] / sizes
+
+    def segments(self, values, bounds):
+        with np.errstate(invalid='ignore'):
+            return _reduce_segments(np.add, values, bounds) / np.diff(bounds)
 
-def correction_dunn_sidak(pvalues):
-    return 1 - (1 - pvalues)**len(pvalues)
 
+class _PermTestMedian(_PermTestStatistic):
+    def __call__(self, samples):
+        return np.median(samples, axis=1)
+
+    def segments(self, values, bounds):
+        counts = np.diff(bounds)
+        nonempty = np.flatnonzero(counts)
+        # Sort values within segments and average the middle ones
+        ids = np.repeat(np.arange(counts.size), counts)
+        values = values[np.lexsort((values, ids))]
+        starts, counts = bounds[nonempty], counts[nonempty]
+        result = np.full(bounds.size - 1, np.nan)
+        result[nonempty] = (values[starts + (counts - 1) // 2] +
+                            values[starts + counts // 2]) / 2
+        return result
+
+
+class _PermTestVar(_PermTestStatistic):
+    def __call__(self, samples):
+        return samples.var(axis=1, ddof=1)
+
+    def prefix(self, samples, sizes):
+        sums = np.cumsum(samples, axis=1)[:, sizes - 1]
+        sums_sq = np.cumsum(samples**2, axis=1)[:, sizes - 1]
+        return (sums_sq - sums**2 / sizes) / (sizes - 1)
+
+    def segments(self, values, bounds):
+        counts = np.diff(bounds)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = _reduce_segments(np.add, values, bounds) / counts
+            m2 = _reduce_segments(np.add, (values - np.repeat(mean, counts))**2, bounds)
+            return m2 / (counts - 1)
+
+
+class _PermTestMin(_PermTestStatistic):
+    def __call__(self, samples):
+        return samples.min(axis=1)
+
+    def prefix(self, samples, sizes):
+        return np.minimum.accumulate(samples, axis=1)[:, sizes - 1]
+
+    def segments(self, values, bounds):
+        return _reduce_segments(np.minimum, values, bounds)
+
+
+class _PermTestMax(_PermTestStatistic):
+    def __call__(self, samples):
+        return samples.max(axis=1)
+
+    def prefix(self, samples, sizes):
+        return np.maximum.accumulate(samples, axis=1)[:, sizes - 1]
+
+    def segments(self, values, bounds):
+        return _reduce_segments(np.maximum, values, bounds)
+
+
+class _PermTestChi2(_PermTestStatistic):
+    """Samples are integer class codes; expected frequencies are scaled
+    to the sample size from the class distribution of the population."""
+    def __init__(self, codes):
+        self.n_classes = codes.max() + 1
+        self.p_exp = np.bincount(codes, minlength=self.n_classes) / codes.size
+
+    def __call__(self, samples):
+        n_samples, n = samples.shape
+        offset = np.arange(n_samples)[:, np.newaxis] * self.n_classes
+        f_obs = np.bincount((samples + offset).ravel(),
+                            minlength=n_samples * self.n_classes)
+        f_obs = f_obs.reshape(n_samples, self.n_classes)
+        f_exp = n * self.p_exp
+        return ((f_obs - f_exp)**2 / f_exp).sum(axis=1)
+
+    def prefix(self, samples, sizes):
+        stat = 0
+        for c, p_exp in enumerate(self.p_exp):
+            f_obs = np.cumsum(samples == c, axis=1)[:, sizes - 1]
+            f_exp = sizes * p_exp
+            stat = stat + (f_obs - f_exp)**2 / f_exp
+        return stat
+
+    def segments(self, values, bounds):
+        counts = np.diff(bounds)
+        ids = np.repeat(np.arange(counts.size), counts)
+        f_obs = np.bincount(ids * self.n_classes + values,
+                            minlength=counts.size * self.n_classes)
+        f_obs = f_obs.reshape(counts.size, self.n_classes)
+        f_exp = counts[:, np.newaxis] * self.p_exp
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return ((f_obs - f_exp)**2 / f_exp).sum(axis=1)
+
+
+class _PermTestCustom(_PermTestStatistic):
+    """User-supplied statistic, a function of a pd.Series"""
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, samples):
+        return np.array([self.func(pd.Series(row)) for row in samples])
+
+
+PERM_TEST_STATISTICS = {
+    'mean': _PermTestMean,
+    'median': _PermTestMedian,
+    'var': _PermTestVar,
+    'min': _PermTestMin,
+    'max': _PermTestMax,
+}
+
+# Upper bound on the number of elements in a single batch of
+# permutation samples (rows x sample size)
+_MAX_BATCH_ELEMENTS = 2**22
+# Upper bounds on rows and groups in a single batch of a closed-form test;
+# cancellation is checked between batches
+_MAX_BATCH_ROWS = 2**20
+_MAX_BATCH_GROUPS = 2**16
+# Upper bound on elements of intermediate arrays of groups x values (or
+# samples) that are processed in chunks
+_MAX_CHUNK_ELEMENTS = 2**20
+
+
+def _sample_indices(rng, N, n, n_samples):
+    """Return (n_samples, n) array of row-wise samples of range(N),
+    drawn without replacement."""
+    if 20 * n * n <= N:
+        # Collisions are rare (birthday bound), so draw with replacement
+        # and redraw only the rows that came out with duplicates
+        idx = rng.integers(N, size=(n_samples, n))
+        idx_sorted = np.sort(idx, axis=1)
+        for i in np.flatnonzero((idx_sorted[:, 1:] == idx_sorted[:, :-1]).any(axis=1)):
+            idx[i] = rng.choice(N, n, replace=False)
+        return idx
+    return np.vstack([rng.choice(N, n, replace=False)
+                      for _ in range(n_samples)])
+
+
+def _null_batch(values, sizes, n_samples, statistic, seed):
+    """Return (n_samples, len(sizes)) array of the statistic over random
+    samples of each size in (sorted) sizes.
+
+    The first n items of a random sample of size sizes[-1] are themselves
+    a random sample of size n, so a single batch of samples (with prefix
+    sums or running extremes) yields samples for all the sizes.
+    """
+    rng = np.random.default_rng(seed)
+    samples = values[_sample_indices(rng, values.size, sizes[-1], n_samples)]
+    if len(sizes) == 1:
+        return statistic(samples)[:, np.newaxis]
+    return statistic.prefix(samples, sizes)
+
+
+# Target values, shared with worker processes of the 'processes' backend
+_shared_values = None
+
+
+def _attach_shared_values(name, shape, dtype):
+    global _shared_values
+    shm = shared_memory.SharedMemory(name=name)
+    _shared_values = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    # Keep a reference to the mapping for the lifetime of the worker
+    _attach_shared_values.shm = shm
+
+
+def _shared_null_batch(sizes, n_samples, statistic, seed):
+    return _null_batch(_shared_values, sizes, n_samples, statistic, seed)
+
+
+def _null_tasks(size_sets, n_iter, statistic, entropy, start=0):
+    """
+    Batches of whole permutation samples, as pairs of the size set's index
+    and arguments of _null_batch. Each batch is seeded from (seed, largest
+    size, batch offset), so the results don't depend on n_jobs, backend,
+    or on other size sets.
+    """
+    tasks = []
+    for i, sizes in enumerate(size_sets):
+        batch = max(1, _MAX_BATCH_ELEMENTS // sizes[-1])
+        for offset in range(start, start + n_iter, batch):
+            tasks.append((i, (sizes, min(batch, start + n_iter - offset), statistic,
+                              np.random.SeedSequence(entropy, spawn_key=(sizes[-1], offset)))))
+    return tasks
 
-def _groupby_agg(x, y, agg, min_count=5, func: callable = lambda x: None):
-    assert x.ndim == 1
-    agg = list(agg) if isinstance(agg, Sequence) and not isinstance(agg, str) else [agg]
-    df = y.groupby(x.values).agg(['count'] + agg)  # type: pd.DataFrame
-    func(df)
 
-    # Make p-values two-tailed by reversing the high-end
+@contextmanager
+def _null_pool(values, n_jobs, backend):
+    """
+    Yield an executor and the function that computes a batch of null
+    samples of values in it; the executor is None for computing in the
+    calling thread. With the 'processes' backend, values are put into
+    shared memory, which is released on exit.
+    """
+    assert backend in ('threading', 'processes')
+    if n_jobs <= 1 and backend == 'threading':
+        yield None, partial(_null_batch, values)
+        return
+    shm = None
+    try:
+        if backend == 'processes':
+            shm = shared_memory.SharedMemory(create=True, size=max(1, values.nbytes))
+            np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+            executor = ProcessPoolExecutor(
+                n_jobs, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_attach_shared_values,
+                initargs=(shm.name, values.shape, values.dtype))
+            func = _shared_null_batch
+        else:
+            executor = ThreadPoolExecutor(n_jobs)
+            func = partial(_null_batch, values)
+        with executor:
+            yield executor, func
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+
+def _null_distributions(values, size_sets, n_iter, statistic, entropy, *,
+                        start=0, n_jobs=1, backend='threading', pool=None,
+                        callback=None, cancel_token=None):
+    """
+    Return, for each array of sizes in size_sets, an (n_iter, len(sizes))
+    array of null distributions of the statistic.
+
+    Work is split into batches of whole permutation samples (see
+    _null_tasks). Samples are numbered from `start`, so that a longer
+    distribution can be computed piecewise. Batches are computed in
+    a `pool` from _null_pool, if given, or in one started for this call.
+    With the 'processes' backend, values are put into shared memory once
+    and the batches are computed in a pool of worker processes.
+    Cancellation is checked after each batch; pending batches are then
+    dropped.
+    """
+    tasks = _null_tasks(size_sets, n_iter, statistic, entropy, start)
+    if not tasks:
+        # Nothing to compute, e.g. all distributions are cached; don't start a pool
+        return [np.empty((n_iter, len(sizes))) for sizes in size_sets]
+    results = [None] * len(tasks)
+
+    def report(n_done):
+        _check_cancelled(cancel_token)
+        if callback:
+            callback(n_done, len(tasks))
+
+    with _null_pool(values, min(effective_n_jobs(n_jobs), len(tasks)), backend) \
+            if pool is None else nullcontext(pool) as (executor, func):
+        if executor is None:
+            _check_cancelled(cancel_token)
+            for i, (_, args) in enumerate(tasks):
+                results[i] = func(*args)
+                report(i + 1)
+        else:
+            futures = {executor.submit(func, *args): i
+                       for i, (_, args) in enumerate(tasks)}
+            try:
+                for n_done, future in enumerate(as_completed(futures), 1):
+                    results[futures[future]] = future.result()
+                    report(n_done)
+            except BaseException:
+                # Don't wait for the pending batches on exit
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    nulls = [[] for _ in size_sets]
+    for (i, _), result in zip(tasks, results):
+        nulls[i].append(result)
+    return [np.vstack(null) for null in nulls]
+
+
+def _sequential_pvals(values, size_sets, sizes, observed, n_iter, h,
+                      statistic, entropy, n_jobs=1, backend='threading',
+                      callback=None, cancel_token=None):
+    """
+    Besag–Clifford sequential p-values of observed statistics of groups
+    with the given (sample) sizes; NaN observations are not tested.
+
+    Null samples are drawn in batches of doubling length. A group stops
+    once both of its tails have at least `h` exceedances, which happens
+    after about h / p samples, with the p-value estimated as h / L from
+    the L samples drawn so far. Groups that don't reach h exceedances
+    within `n_iter` samples get the usual (g + 1) / (n_iter + 1).
+    Sampling of a size set stops when all its groups have stopped.
+    Exceedances are counted in blocks of samples, from which stopped groups
+    are dropped, so the (samples x groups) arrays stay small. All rounds
+    are computed in the same pool (see _null_pool).
+    """
+    n_le = np.zeros(observed.size, dtype=int)
+    n_ge = np.zeros(observed.size, dtype=int)
+    pvals = np.full(observed.size, np.nan)
+    active = ~np.isnan(observed)
+    # The pool's size is bounded by the number of batches of all samples
+    n_tasks = len(_null_tasks(size_sets, n_iter, statistic, entropy))
+    with _null_pool(values, min(effective_n_jobs(n_jobs), n_tasks), backend) \
+            if active.any() else nullcontext() as pool:
+        done = 0
+        while done < n_iter and active.any():
+            n_samples = min(max(2 * h, done), n_iter - done)
+            active_sets = [size_set for size_set in size_sets
+                           if active[np.isin(sizes, size_set)].any()]
+            computed = _null_distributions(values, active_sets, n_samples, statistic,
+                                           entropy, start=done, pool=pool,
+                                           cancel_token=cancel_token)
+            for size_set, null in zip(active_sets, computed):
+                for n, column in zip(size_set, null.T):
+                    group = np.flatnonzero(active & (sizes == n))
+                    block = max(1, _MAX_CHUNK_ELEMENTS // max(group.size, 1))
+                    for start in range(0, column.size, block):
+                        if not group.size:
+                            break
+                        sample = column[start:start + block, np.newaxis]
+                        # Running counts of exceedances in each tail, sample by sample
+                        le = n_le[group] + np.cumsum(sample <= observed[group], axis=0)
+                        ge = n_ge[group] + np.cumsum(sample >= observed[group], axis=0)
+                        n_le[group], n_ge[group] = le[-1], ge[-1]
+
+                        reached = np.minimum(le, ge) >= h
+                        stopped = reached.any(axis=0)
+                        at = reached.argmax(axis=0)[stopped]
+                        n_drawn = done + start + at + 1
+                        low = le[at, stopped] / n_drawn
+                        high = ge[at, stopped] / n_drawn
+                        pvals[group[stopped]] = np.where(low <= high, low, 1 - high)
+                        active[group[stopped]] = False
+                        group = group[~stopped]
+            done += n_samples
+            if callback:
+                callback(done, n_iter)
+
+    low = (n_le[active] + 1) / (n_iter + 1)
+    high = (n_ge[active] + 1) / (n_iter + 1)
+    pvals[active] = np.where(low <= high, low, 1 - high)
+    return pvals
+
+
+class NullDistributionCache:
+    """
+    Persistent on-disk cache of permutation test null distributions.
+
+    Entries are stored as .npy files in `path`. When their total size
+    exceeds `max_size` bytes, the least recently used ones are removed.
+    """
+    def __init__(self, path, max_size=2**28):
+        self.path = path
+        self.max_size = max_size
+
+    def _filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode()).hexdigest() + '.npy')
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            value = np.load(filename)
+            # Mark as recently used
+            os.utime(filename)
+        except (OSError, ValueError):
+            return None
+        return value
+
+    def put(self, key, value):
+        os.makedirs(self.path, exist_ok=True)
+        # Write to a temporary file first so that concurrent readers
+        # never see partially written entries
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, value)
+        os.replace(tmp, self._filename(key))
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        if os.path.isdir(self.path):
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.npy'):
+                    os.remove(entry.path)
+
+
+def correction_dunn_sidak(pvalues, n_tests=None):
+    return 1 - (1 - pvalues)**(len(pvalues) if n_tests is None else n_tests)
+
+
+def correction_bonferroni(pvalues, n_tests=None):
+    return np.minimum(1, pvalues * (len(pvalues) if n_tests is None else n_tests))
+
+
+def correction_benjamini_hochberg(pvalues, n_tests=None):
+    """False discovery rate adjusted p-values; the untested of `n_tests`
+    are taken to have p-value 1"""
+    pvalues = pd.Series(pvalues)
+    n_tests = len(pvalues) if n_tests is None else n_tests
+    order = np.argsort(pvalues.values, kind='stable')
+    adjusted = pvalues.values[order] * n_tests / np.arange(1, len(order) + 1)
+    adjusted = np.minimum.accumulate(adjusted[::-1])[::-1]
+    result = np.empty(len(order))
+    result[order] = np.minimum(1, adjusted)
+    return pd.Series(result, index=pvalues.index)
+
+
+CORRECTIONS = OrderedDict((
+    ('Šidák', correction_dunn_sidak),
+    ('Bonferroni', correction_bonferroni),
+    ('Benjamini–Hochberg', correction_benjamini_hochberg),
+))
+
+
+def _finalize(df, name, min_count, n_tests=None):
+    # Make p-values two-tailed by reversing the high-end. Tests that report
+    # the method of each group (see _SizePlannedTest) already give two-sided
+    # p-values, by either method.
     pv = df['pval']
-    df['pval'] = pv = pv.where(pv < .5, 1 - pv)
-    assert (pv.fillna(0) <= .5).all()
+    if 'method' not in df:
+        df['pval'] = pv = pv.where(pv < .5, 1 - pv)
+        assert (pv.fillna(0) <= .5).all()
 
-    df[CORRECTED_LABEL] = correction_dunn_sidak(pv)
+    df[CORRECTED_LABEL] = correction_dunn_sidak(pv, n_tests)
     df.rename(columns=COLUMN_RENAMES, inplace=True)
 
     df = df[df['count'] >= min_count]
     df.dropna(inplace=True)
-    df.index.name = x.name
+    df.index.name = name
+    # For re-correction of a subset of results
+    if np.ndim(n_tests) == 0:
+        df.attrs['n_tests'] = len(pv) if n_tests is None else n_tests
     return df
 
 
+def _group_frame(x, columns, min_count=5):
+    """Result frame from a list of (name, per-group array) pairs that
+    include 'count' and 'pval'"""
+    columns = OrderedDict(columns)
+    groups = np.flatnonzero(columns['count'] >= min_count)
+    df = pd.DataFrame(OrderedDict((name, np.asarray(values)[groups])
+                                  for name, values in columns.items()),
+                      index=pd.Index(x.labels(groups), dtype=object,
+                                     tupleize_cols=False))
+    # Only labels of reported groups are decoded, but all are corrected for
+    return _finalize(df, x.name, min_count, n_tests=x.n_groups)
+
+
+def _group_moments(codes, values, n_groups):
+    """Per-group counts, means and sums of squared deviations from the mean"""
+    count = np.bincount(codes, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(codes, values, minlength=n_groups) / count
+    m2 = np.bincount(codes, (values - mean[codes])**2, minlength=n_groups)
+    return count, mean, m2
+
+
+def _t_pval(count, mean, m2, popmean):
+    # One-sample t-test, as scipy.stats.ttest_1samp, from group moments
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = (mean - popmean) / np.sqrt(m2 / (count - 1) / count)
+        return 2 * student_t.sf(np.abs(t), count - 1)
+
+
+@lru_cache(maxsize=256)
+def _fligner_mean_scores(m):
+    """Means of Fligner-Killeen scores and of their squares for a sample
+    of size m without ties; cached for batches of groups of equal sizes"""
+    a = ndtri(np.arange(1, m + 1) / (2 * (m + 1)) + .5)
+    return a.sum() / m, (a**2).sum() / m
+
+
+def _fligner_scores_moments(M):
+    """Sums of Fligner-Killeen scores and of their squares for samples
+    of sizes M, assuming no ties"""
+    unique_M = np.unique(M)
+    # Scaled moments are smooth in M; compute them exactly on a grid
+    # and interpolate for the rest
+    N_GRID = 16
+    grid = (unique_M if unique_M.size <= N_GRID else
+            np.unique(np.linspace(unique_M[0], unique_M[-1], N_GRID).round().astype(int)))
+    mean_a, mean_a2 = np.array([_fligner_mean_scores(m) for m in grid]).T
+    return (np.interp(M, grid, mean_a) * M,
+            np.interp(M, grid, mean_a2) * M)
+
+
+# Closed-form group tests. A test is constructed from the target values
+# of the population and called with group codes of rows and the number of
+# groups. If groups don't span all rows, `rows` holds the indices of the
+# rows the codes belong to; a row may then belong to several groups.
+# The call returns a list of (name, per-group array) pairs, see _group_frame.
+class _GroupTest(ABC):
+    norm_y = False
+    min_count = 5
+
+    def __init__(self, y):
+        self.values = np.asarray(y)
+
+    def _values(self, rows):
+        return self.values if rows is None else self.values[rows]
+
+    @abstractmethod
+    def __call__(self, codes, n_groups, rows=None):
+        pass
+
+    @classmethod
+    def multi(cls, Y, codes, n_groups, **kwargs):
+        """
+        Test each column of frame Y (with missing values) on the same groups.
+        Return (name, (n_groups, n_targets) array) pairs.
+
+        Tests override this with matrix operations over all targets.
+        """
+        results = []
+        for _, y in Y.items():
+            valid = y.notnull().values
+            test = cls(_check_y(y[valid], norm_y=cls.norm_y), **kwargs)
+            results.append(OrderedDict(test(codes[valid], n_groups)))
+        return [(name, np.column_stack([result[name] for result in results]))
+                for name in results[0]]
+
+
+def _group_indicator(codes, n_groups):
+    """Sparse (n_groups, n_rows) indicator matrix of group membership;
+    multiplying it with a matrix sums its rows within groups"""
+    return sp.csr_matrix((np.ones(codes.size), (codes, np.arange(codes.size))),
+                         shape=(n_groups, codes.size))
+
+
+def _group_reduce(ufunc, values, codes, n_groups):
+    """Reduce rows of 2-D values within each group; all groups must be non-empty"""
+    order = np.argsort(codes, kind='stable')
+    starts = np.searchsorted(codes[order], np.arange(n_groups))
+    return ufunc.reduceat(values[order], starts, axis=0)
+
+
+def _masked_matrix(Y):
+    """Float matrix of Y with missing values set to 0 and the mask of known values"""
+    # Frames are stored by columns; group sums need rows contiguous
+    Y = np.ascontiguousarray(Y, dtype=float)
+    known = ~np.isnan(Y)
+    return np.where(known, Y, 0), known
+
+
+class _TTest(_GroupTest):
+    norm_y = True
+
+    def __init__(self, y):
+        super().__init__(np.asarray(y, dtype=float))
+        self.popmean = self.values.mean()
+
+    def __call__(self, codes, n_groups, rows=None):
+        count, mean, m2 = _group_moments(codes, self._values(rows), n_groups)
+        return [('count', count),
+                ('pval', _t_pval(count, mean, m2, self.popmean))]
+
+    @classmethod
+    def multi(cls, Y, codes, n_groups):
+        # t is invariant to scaling, so Y is only centered, which also
+        # keeps the one-pass sums of squares accurate
+        values, known = _masked_matrix(Y)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values -= values.sum(axis=0) / known.sum(axis=0)
+        values[~known] = 0
+        indicator = _group_indicator(codes, n_groups)
+        count = np.rint(indicator @ known.astype(float)).astype(int)
+        sums = indicator @ values
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = sums / count
+            m2 = np.maximum(indicator @ values**2 - sums * mean, 0)
+        return [('count', count),
+                ('pval', _t_pval(count, mean, m2, 0))]
+
+
+class _Chi2Test(_GroupTest):
+    """Goodness-of-fit of each group's class frequencies to the class
+    distribution of the population"""
+    def __init__(self, y, ddof=0):
+        super().__init__(pd.factorize(y)[0])
+        self.n_classes = self.values.max() + 1
+        self.f_pop = np.bincount(self.values, minlength=self.n_classes)
+        self.ddof = ddof
+
+    def __call__(self, codes, n_groups, rows=None):
+        table = np.bincount(codes * self.n_classes + self._values(rows),
+                            minlength=n_groups * self.n_classes)
+        table = table.reshape(n_groups, self.n_classes)
+        return self.from_table(table, self.f_pop, self.ddof)
+
+    @staticmethod
+    def from_table(table, f_pop, ddof=0):
+        """Test from (n_groups, n_classes) class frequencies of groups"""
+        count = table.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            f_exp = count[:, np.newaxis] * (f_pop / f_pop.sum())
+            stat = ((table - f_exp)**2 / f_exp).sum(axis=1)
+        pval = chi2.sf(stat, f_pop.size - 1 - ddof)
+        # Chi-squared approximation is invalid for small frequencies
+        pval[(table < 5).any(axis=1) | (f_pop < 5).any()] = np.nan
+        return [('count', count),
+                ('pval', pval)]
+
+
+class _HyperTest(_GroupTest):
+    def __init__(self, y):
+        super().__init__(y)
+        assert self.values.dtype == bool
+        # N, n, K, k as in https://en.wikipedia.org/wiki/Hypergeometric_distribution#Definition
+        self.N, self.K = self.values.size, self.values.sum()
+
+    def __call__(self, codes, n_groups, rows=None):
+        n = np.bincount(codes, minlength=n_groups)
+        k = np.bincount(codes[self._values(rows)], minlength=n_groups)
+        return self.from_counts(n, k, self.N, self.K)
+
+    @classmethod
+    def multi(cls, Y, codes, n_groups):
+        values, known = _masked_matrix(Y)
+        indicator = _group_indicator(codes, n_groups)
+        n = np.rint(indicator @ known.astype(float)).astype(int)
+        k = np.rint(indicator @ values).astype(int)
+        return cls.from_counts(n, k, known.sum(axis=0), values.sum(axis=0))
+
+    @staticmethod
+    def from_counts(n, k, N, K):
+        """Test from group sizes n and their counts k of positives"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            enrichment = (k / n) / (K / N)
+        return [('count', n),
+                ('sum', k),
+                ('enrichment', enrichment),
+                ('pval', hypergeom.sf(k - 1, N, K, n))]
+
+
+class _SizePlannedTest(_GroupTest):
+    """
+    Base for rank tests whose approximations are cheap for any group size
+    but unreliable for small groups. Groups with fewer than
+    `perm_max_count` rows are tested by permutation instead: the
+    approximate p-value serves as the statistic, computed over `n_perm`
+    random samples of the group's size drawn from the population. The
+    method used is reported for each group. P-values of both methods are
+    two-sided, and _finalize doesn't reverse them.
+
+    The null distribution of each size is computed once per test object,
+    so it's shared by all batches and column sets. Groups with fewer than
+    `min_tested_count` rows, which the caller discards, aren't permuted.
+    Long computations check `cancel_token` (see CancellationToken).
+    """
+    perm_max_count = 20
+    n_perm = 1000
+
+    def __init__(self, y, min_tested_count=1, cancel_token=None):
+        super().__init__(y)
+        self.min_tested_count = min_tested_count
+        self.cancel_token = cancel_token
+        self._nulls = {}
+
+    @abstractmethod
+    def _approximate(self, codes, n_groups, rows=None):
+        pass
+
+    def _null(self, n):
+        """Sorted approximate p-values of random samples of size n"""
+        if n not in self._nulls:
+            rng = np.random.default_rng([0, n])
+            samples = _sample_indices(rng, self.values.size, n, self.n_perm)
+            self._nulls[n] = np.sort(dict(self._approximate(
+                np.repeat(np.arange(self.n_perm), n), self.n_perm, samples.ravel()))['pval'])
+        return self._nulls[n]
+
+    def __call__(self, codes, n_groups, rows=None):
+        columns = OrderedDict(self._approximate(codes, n_groups, rows))
+        count, pval = columns['count'], columns['pval']
+        small = ((count > 0) & (count >= self.min_tested_count) &
+                 (count < self.perm_max_count))
+        for n in np.unique(count[small]):
+            null = self._null(n)
+            group = small & (count == n)
+            pval[group] = ((np.searchsorted(null, pval[group], side='right') + 1) /
+                           (self.n_perm + 1))
+        columns['method'] = np.where(small, 'permutation', 'approximate').astype(object)
+        return list(columns.items())
+
+
+class _MannWhitneyUTest(_SizePlannedTest):
+    """
+    Two-sided Mann-Whitney U test of each group against the whole
+    population, as scipy.stats.mannwhitneyu(group, y) (asymptotic, with
+    continuity and tie correction), from a single global ranking.
+
+    Rank of a group item among group + population is its population rank
+    plus its rank within group, less 1/2, so U of the group is
+    sum(population ranks) - n/2. Small groups are tested by permutation.
+    """
+    norm_y = True
+
+    def __init__(self, y, **kwargs):
+        super().__init__(np.asarray(y, dtype=float), **kwargs)
+        self.ranks = rankdata(self.values)
+        uniques, self.value_ids = np.unique(self.values, return_inverse=True)
+        self.n_uniques = uniques.size
+        self.t_pop = np.bincount(self.value_ids).astype(float)
+        self.pop_tie_term = (self.t_pop**3 - self.t_pop).sum()
+
+    def _approximate(self, codes, n_groups, rows=None):
+        N = self.values.size
+        count = np.bincount(codes, minlength=n_groups)
+        ranks = self.ranks if rows is None else self.ranks[rows]
+        U = np.bincount(codes, ranks, minlength=n_groups) - count / 2
+
+        # Each value v tied t_pop(v) times in population and t_grp(v) times
+        # in group is tied t_pop(v) + t_grp(v) times in the joint sample
+        if self.n_uniques == N:
+            # Without ties in population, each group value is tied twice
+            tie_term = 6 * count
+        else:
+            value_ids = self.value_ids if rows is None else self.value_ids[rows]
+            pairs, t_grp = np.unique(codes.astype(np.int64) * self.n_uniques + value_ids,
+                                     return_counts=True)
+            t_pop = self.t_pop[pairs % self.n_uniques]
+            t_joint = t_pop + t_grp
+            tie_term = self.pop_tie_term + np.bincount(
+                pairs // self.n_uniques, (t_joint**3 - t_joint) - (t_pop**3 - t_pop),
+                minlength=n_groups)
+
+        M = count + N
+        mu = count * N / 2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sigma = np.sqrt(count * N / 12 * ((M + 1) - tie_term / (M * (M - 1))))
+            z = (np.abs(U - mu) - .5) / sigma
+        return [('count', count),
+                ('pval', np.clip(2 * norm.sf(z), 0, 1))]
+
+
+class _FlignerTest(_SizePlannedTest):
+    """
+    Fligner-Killeen test of each group against the whole population, as
+    scipy.stats.fligner(group, y).
+
+    Joint ranks of the group's absolute deviations are computed from
+    a single sorted copy of the population's. Without ties of deviations,
+    sums over all joint scores depend only on the joint size; otherwise
+    they are corrected for tie-averaged ranks in each group's joint sample,
+    with work proportional to the population's ties. Small
+    groups are tested by permutation. The test is scale-invariant, so y
+    isn't normalized, which could break ties of deviations.
+    """
+
+    def __init__(self, y, **kwargs):
+        super().__init__(np.asarray(y, dtype=float), **kwargs)
+        self.pop_dev = np.sort(np.abs(self.values - np.median(self.values)))
+        self.pop_uniques, self.pop_counts = np.unique(self.pop_dev, return_counts=True)
+        # Ranks are of deviations, which can tie also for distinct values
+        self.tied = self.pop_uniques.size < self.pop_dev.size
+
+    def _tied_scores_moments(self, codes, n_groups, dev):
+        """Sums of joint scores and of their squares, with tie-averaged
+        ranks, of each group joined with the population.
+
+        These are the sums without ties, corrected for each block of tied
+        deviations in the joint sample. Blocks of the population's tied
+        deviations are shifted by the number of group's deviations below
+        them. For sizes with few groups, these are counted with a bincount
+        over (group, tied deviation) codes, in chunks of groups, with
+        cancellation checked for each. Otherwise, corrections for each
+        shift are summed over the population's deviations in advance, and
+        looked up for ranges between the group's deviations. Blocks are
+        then widened by the group's deviations equal to them."""
+        N = self.values.size
+        uniques, counts = self.pop_uniques, self.pop_counts
+        tied = counts > 1
+        tied_counts = counts[tied]
+        tied_before = (np.cumsum(counts) - counts)[tied]
+        n_tied = tied_counts.size
+
+        count = np.bincount(codes, minlength=n_groups)
+        S, Q = _fligner_scores_moments(count + N)
+
+        # Rows by groups and deviations; group's tie blocks start at `first`
+        order = np.lexsort((dev, codes))
+        sorted_codes, sorted_dev = codes[order], dev[order]
+        group_first = np.r_[0, np.cumsum(count)]
+        # Number of population's tied deviations up to each row's
+        above = np.searchsorted(uniques[tied], sorted_dev, side='right')
+        first = np.flatnonzero(np.r_[True, (np.diff(sorted_codes) != 0) |
+                                     (np.diff(sorted_dev) != 0)])
+        block_codes = sorted_codes[first]
+        left = np.searchsorted(self.pop_dev, sorted_dev[first], side='left')
+        pop_count = np.searchsorted(self.pop_dev, sorted_dev[first], side='right') - left
+        block_start = left + first - group_first[block_codes]
+        block_size = pop_count + np.diff(np.r_[first, dev.size])
+        block_order = np.argsort(count[block_codes], kind='stable')
+        block_bounds = np.r_[0, np.cumsum(np.bincount(count[block_codes],
+                                                      minlength=count.max() + 1))]
+
+        groups_by_size = np.argsort(count, kind='stable')
+        size_bounds = np.r_[0, np.cumsum(np.bincount(count))]
+        for n in np.flatnonzero(np.bincount(count)[1:]) + 1:
+            _check_cancelled(self.cancel_token)
+            groups = groups_by_size[size_bounds[n]:size_bounds[n + 1]]
+            k = groups.size
+            corrections = self._block_corrections(
+                N + n, min(k, n + 1) * tied_counts.sum() + k * n)
+
+            # Blocks with group's deviations
+            blocks = block_order[block_bounds[n]:block_bounds[n + 1]]
+            start = block_start[blocks]
+            dS, dQ = corrections(start, block_size[blocks])
+            tS, tQ = corrections(start, pop_count[blocks])
+            S += np.bincount(block_codes[blocks], dS - tS, minlength=n_groups)
+            Q += np.bincount(block_codes[blocks], dQ - tQ, minlength=n_groups)
+            if not n_tied:
+                continue
+
+            # Blocks of population's tied deviations, shifted
+            group_above = above[group_first[groups][:, None] + np.arange(n)]
+            if n + 1 < k:
+                # Ranges of blocks with the same shift, in chunks of shifts
+                lower = np.column_stack((np.zeros(k, dtype=int), group_above))
+                upper = np.column_stack((group_above, np.full(k, n_tied)))
+                chunk = max(1, _MAX_CHUNK_ELEMENTS // (n_tied + k))
+                for shift_start in range(0, n + 1, chunk):
+                    _check_cancelled(self.cancel_token)
+                    shifts = np.arange(shift_start, min(shift_start + chunk, n + 1))
+                    corrected = corrections(
+                        (tied_before + shifts[:, None]).ravel(),
+                        np.tile(tied_counts, shifts.size))
+                    for sums, d in zip((S, Q), corrected):
+                        cum = np.zeros((shifts.size, n_tied + 1))
+                        np.cumsum(d.reshape(shifts.size, n_tied), axis=1, out=cum[:, 1:])
+                        index = shifts - shift_start
+                        sums[groups] += (cum[index, upper[:, shifts]]
+                                         - cum[index, lower[:, shifts]]).sum(axis=1)
+                continue
+
+            chunk = max(1, _MAX_CHUNK_ELEMENTS // (n_tied + 1))
+            for chunk_start in range(0, k, chunk):
+                _check_cancelled(self.cancel_token)
+                chunk_above = group_above[chunk_start:chunk_start + chunk]
+                m = chunk_above.shape[0]
+                below = np.bincount(
+                    (np.arange(m)[:, None] * (n_tied + 1) + chunk_above).ravel(),
+                    minlength=m * (n_tied + 1))
+                below = below.reshape(m, n_tied + 1).cumsum(axis=1)[:, :-1]
+                dS, dQ = corrections((tied_before + below).ravel(),
+                                     np.tile(tied_counts, m))
+                chunk_groups = groups[chunk_start:chunk_start + chunk]
+                S[chunk_groups] += dS.reshape(m, n_tied).sum(axis=1)
+                Q[chunk_groups] += dQ.reshape(m, n_tied).sum(axis=1)
+        S[count == 0] = Q[count == 0] = np.nan
+        return S, Q
+
+    @staticmethod
+    def _block_corrections(M, cost):
+        """A function that takes the first ranks minus one (`start`) and sizes
+        of blocks of tied ranks in joint samples of size M, and returns
+        differences between sums of tied and untied scores over each block,
+        and between sums of their squares.
+
+        Scores for all half-integer ranks are tabulated if this is cheaper
+        than the estimated `cost` of computing them for each block."""
+        def score(rank):
+            return ndtri(rank / (2 * (M + 1)) + .5)
+
+        if 2 * M < cost:
+            half = score(np.arange(1, 2 * M + 1) / 2)
+            sums = np.r_[0, np.cumsum(half[1::2])]
+            sums2 = np.r_[0, np.cumsum(half[1::2]**2)]
+
+            def corrections(start, size):
+                end = start + size
+                average = half[2 * start + size]
+                return (size * average - (sums[end] - sums[start]),
+                        size * average**2 - (sums2[end] - sums2[start]))
+        else:
+            def corrections(start, size):
+                block = np.repeat(np.arange(size.size), size)
+                offset = np.arange(block.size) - np.repeat(np.cumsum(size) - size, size)
+                a = score(start[block] + offset + 1)
+                average = score(start + (size + 1) / 2)
+                return (size * average - np.bincount(block, a, minlength=size.size),
+                        size * average**2 - np.bincount(block, a**2, minlength=size.size))
+        return corrections
+
+    def _approximate(self, codes, n_groups, rows=None):
+        N = self.values.size
+        values = self._values(rows)
+        count = np.bincount(codes, minlength=n_groups)
+        dev = np.abs(values - pd.Series(values).groupby(codes).transform('median').values)
+
+        left = np.searchsorted(self.pop_dev, dev, side='left')
+        right = np.searchsorted(self.pop_dev, dev, side='right')
+        group_rank = pd.Series(dev).groupby(codes).rank(method='average').values
+        joint_rank = left + (right - left) / 2 + group_rank
+
+        M = count + N
+        a = ndtri(joint_rank / (2 * (M[codes] + 1)) + .5)
+        A = np.bincount(codes, a, minlength=n_groups)
+        if self.tied:
+            S, Q = self._tied_scores_moments(codes, n_groups, dev)
+        else:
+            S, Q = _fligner_scores_moments(M)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            a_mean = S / M
+            var_a = (Q - S**2 / M) / (M - 1)
+            stat = (count * (A / count - a_mean)**2 +
+                    N * ((S - A) / N - a_mean)**2) / var_a
+        return [('count', count),
+                ('pval', chi2.sf(stat, 1))]
+
+
+class _GumbelMinTest(_GroupTest):
+    norm_y = True
+    _agg, _dist = 'min', gumbel_l
+
+    def __call__(self, codes, n_groups, rows=None):
+        extreme = (pd.Series(self._values(rows)).groupby(codes).agg(self._agg)
+                   .reindex(np.arange(n_groups)).values)
+        return [('count', np.bincount(codes, minlength=n_groups)),
+                ('pval', self._dist.cdf(extreme))]
+
+    @classmethod
+    def multi(cls, Y, codes, n_groups):
+        values, known = _masked_matrix(Y)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = values.sum(axis=0) / known.sum(axis=0)
+            std = np.sqrt((np.where(known, values - mean, 0)**2).sum(axis=0) /
+                          (known.sum(axis=0) - 1))
+        ufunc, fill = (np.minimum, np.inf) if cls._agg == 'min' else (np.maximum, -np.inf)
+        extreme = _group_reduce(ufunc, np.where(known, (values - mean) / std, fill),
+                                codes, n_groups)
+        extreme[np.isinf(extreme)] = np.nan
+        count = np.rint(_group_indicator(codes, n_groups) @ known.astype(float)).astype(int)
+        return [('count', count),
+                ('pval', cls._dist.cdf(extreme))]
+
+
+class _GumbelMaxTest(_GumbelMinTest):
+    _agg, _dist = 'max', gumbel_r
+
+
+GROUP_TESTS = OrderedDict((
+    ('t', _TTest),
+    ('fligner', _FlignerTest),
+    ('mannwhitneyu', _MannWhitneyUTest),
+    ('chi2', _Chi2Test),
+    ('hyper', _HyperTest),
+    ('gumbel_min', _GumbelMinTest),
+    ('gumbel_max', _GumbelMaxTest),
+))
+
+
+def _test_in_batches(group_test, codes, n_groups, callback=None, cancel_token=None):
+    """
+    Call group_test on batches of whole groups of about _MAX_BATCH_ROWS
+    rows and at most _MAX_BATCH_GROUPS groups. Cancellation is checked and
+    progress reported after each batch, also if there is only one.
+    """
+    counts = np.bincount(codes, minlength=n_groups)
+    bounds = np.r_[0, np.cumsum(counts)]
+    new_batch = ((np.diff(bounds[:-1] // _MAX_BATCH_ROWS) != 0)
+                 | (np.diff(np.arange(n_groups) // _MAX_BATCH_GROUPS) != 0))
+    edges = np.r_[0, np.flatnonzero(new_batch) + 1, n_groups]
+    n_batches = edges.size - 1
+
+    _check_cancelled(cancel_token)
+    if n_batches <= 1:
+        results = [group_test(codes, n_groups)]
+        _check_cancelled(cancel_token)
+        if callback:
+            callback(1, 1)
+    else:
+        order = np.argsort(codes, kind='stable')
+        results = []
+        for i, (start, end) in enumerate(zip(edges[:-1], edges[1:])):
+            rows = order[bounds[start]:bounds[end]]
+            results.append(group_test(codes[rows] - start, end - start, rows=rows))
+            _check_cancelled(cancel_token)
+            if callback:
+                callback(i + 1, n_batches)
+    return [(name, np.concatenate([dict(result)[name] for result in results]))
+            for name, _ in results[0]]
+
+
+def _run_group_test(X, y, test, min_count, *, callback=None, cancel_token=None,
+                    **kwargs):
+    x, y = _check_Xy(X, y, norm_y=test.norm_y)
+    min_count = max(min_count, test.min_count)
+    if issubclass(test, _SizePlannedTest):
+        kwargs.update(min_tested_count=min_count, cancel_token=cancel_token)
+    columns = _test_in_batches(test(y, **kwargs), x.codes, x.n_groups,
+                               callback=callback, cancel_token=cancel_token)
+    return _group_frame(x, columns, min_count)
+
+
 def perm_test(X, y, *, statistic='mean', n_iter=300, n_jobs=1,
               min_count=5, exact_sample_size=False, verbose=False,
-              callback=None):
+              callback=None, seed=None, sampling='independent',
+              backend='threading', null_cache=None, early_stopping=None,
+              cancel_token=None):
+    """
+    Permutation test of each group's statistic against samples of y.
+
+    With `sampling='independent'`, a separate set of samples is drawn for
+    each (rounded) group size. With `sampling='nested'`, one set of
+    samples of the largest group size is drawn and its prefixes are used
+    as samples of all the smaller sizes, so the cost doesn't grow with
+    the number of distinct group sizes.
+
+    Batches of samples are computed in `n_jobs` threads or, with
+    `backend='processes'`, worker processes that share y through shared
+    memory (custom statistics must then be picklable). `callback` is
+    called with the number of completed and all batches; if
+    `cancel_token` (see CancellationToken) is cancelled meanwhile,
+    Cancelled is raised after the running batches.
+
+    If `null_cache` (a NullDistributionCache) is given and `seed` is set,
+    null distributions of built-in statistics are looked up in and stored
+    to it, so re-running the test on an unchanged target skips sampling.
+
+    If `early_stopping` is set to h (e.g. 10), p-values are computed with
+    Besag–Clifford sequential sampling: each group stops sampling after
+    h exceedances in both tails, so clearly non-significant groups stop
+    after a few dozen samples and only borderline groups use all `n_iter`.
+    The null cache is not used then.
+    """
+    assert sampling in ('independent', 'nested')
     x, y = _check_Xy(X, y, norm_y=statistic != 'chi2')
     min_count = max(min_count, 5)
 
-    STATISTICS = {
-        'mean': pd.Series.mean,
-        'median': pd.Series.median,
-        'var': pd.Series.var,
-        'min': pd.Series.min,
-        'max': pd.Series.max,
-        'chi2': _PermTestChi2(y),
-    }
-    assert statistic in STATISTICS or callable(statistic)
-    statistic_func = STATISTICS.get(statistic) or statistic
-
-    # Compute the p-value by integrating the discrete tail directly
-    def pv_cdf(score, scores):
-        return (np.sum(scores <= score) + 1) / (scores.size + 1)
-
-    cache = {}
-    parallel = Parallel(n_jobs=n_jobs, backend='threading')
-
-    if callback:
-        assert callable(callback)
-        _n = 0
-
-        def callback(callback=callback, _n_groups = x.nunique()):
-            nonlocal _n
-            _n += 1
-            callback(_n, _n_groups)
-
-    def pval(group):
-        nonlocal y, pv_cdf, statistic_func, exact_sample_size, cache, parallel, callback
-        n = len(group)
-
-        if callback:
-            callback()
-
-        if n < min_count:
-            return np.nan
-
-        # Round n to order of magnitude for more cache hits
+    if statistic == 'chi2':
+        values = pd.factorize(y)[0]
+        statistic_func = _PermTestChi2(values)
+    else:
+        assert statistic in PERM_TEST_STATISTICS or callable(statistic)
+        values = np.asarray(y, dtype=float)
+        statistic_func = (PERM_TEST_STATISTICS[statistic]()
+                          if statistic in PERM_TEST_STATISTICS else
+                          _PermTestCustom(statistic))
+
+    codes = x.codes
+    counts = np.bincount(codes, minlength=x.n_groups)
+    tested = counts >= min_count
+
+    # Statistic of each group, computed over its slice of rows sorted by group
+    order = np.argsort(codes, kind='mergesort')
+    bounds = np.r_[0, np.cumsum(counts)]
+    observed = statistic_func.segments(values[order], bounds)
+    observed[~tested] = np.nan
+
+    # Round n to order of magnitude for more shared null distributions
+    # and clip it to y size
+    def sample_size(n):
         if not exact_sample_size:
             n = round(n, -int(np.log10(n)))
-
-        # Clip n to y size to avoid 'larger sample than population'
-        # error in pd.Series.sample()
-        n = min(n, len(y))
-
-        sample_distance = statistic_func(group)
-
-        distances = cache.get(n)
-        print('' if distances is None else n, sep='', end='.')
-        if distances is None:
-            # Stage 1: Compute only 100 iterations
-            N1_ITER = 50
-            distances, n_iter_remaining = [], n_iter
-            if n_iter >= 2*N1_ITER:
-                n_iter_remaining -= N1_ITER
-                distances = np.array(
-                    parallel(delayed(statistic_func)(y.sample(n))
-                             for _ in range(N1_ITER)))
-
-                # If p-value of first stage iterations is not significant,
-                # do not continue
-                pv = pv_cdf(sample_distance, distances)
-                if pv > .2 or pv < .8:
-                    return pv
-
-            # Stage 2: Compute the rest n_iter iterations
-            cache[n] = distances = np.r_[
-                distances,
-                parallel(delayed(statistic_func)(y.sample(n))
-                         for _ in range(n_iter_remaining))
-            ]
-
-        return pv_cdf(sample_distance, distances)
+        return min(n, values.size)
+
+    sizes = np.array([sample_size(n) if n else 0 for n in counts])
+    unique_sizes = np.unique(sizes[tested])
+
+    entropy = np.random.SeedSequence(seed).entropy
+    pvals = np.full(counts.size, np.nan)
+
+    if sampling == 'nested':
+        size_sets = [unique_sizes] if unique_sizes.size else []
+    else:
+        size_sets = [unique_sizes[i:i + 1] for i in range(unique_sizes.size)]
+
+    if early_stopping:
+        pvals = _sequential_pvals(values, size_sets, sizes, observed, n_iter,
+                                  early_stopping, statistic_func, entropy,
+                                  n_jobs=n_jobs, backend=backend, callback=callback,
+                                  cancel_token=cancel_token)
+        return _group_frame(x, [('count', counts), ('pval', pvals)], min_count)
+
+    # Null distributions are reproducible (and thus cacheable) only for
+    # a fixed seed and a known statistic
+    nulls = {}
+    if null_cache is not None and seed is not None and isinstance(statistic, str):
+        y_hash = hashlib.sha1(values.tobytes() + str(values.dtype).encode()).hexdigest()
+
+        def cache_key(n, size_set):
+            return y_hash, statistic, int(n), int(size_set[-1]), n_iter, seed
+
+        for size_set in size_sets:
+            cached = [null_cache.get(cache_key(n, size_set)) for n in size_set]
+            if all(null is not None for null in cached):
+                nulls.update(zip(size_set, cached))
+        size_sets = [size_set for size_set in size_sets if size_set[0] not in nulls]
+    else:
+        null_cache = None
 
     with patch(sys, 'stdout', sys.stdout if verbose else None):
-        res = _groupby_agg(x, y, pval, min_count=min_count)
+        # With a warm cache, there may be nothing left to sample
+        computed = _null_distributions(values, size_sets, n_iter, statistic_func, entropy,
+                                       n_jobs=n_jobs, backend=backend, callback=callback,
+                                       cancel_token=cancel_token) if size_sets else []
+        for size_set, null in zip(size_sets, computed):
+            for n, column in zip(size_set, null.T):
+                nulls[n] = column
+                if null_cache is not None:
+                    null_cache.put(cache_key(n, size_set), column)
+
+        for n in unique_sizes:
+            print(n, end='.')
+            null = np.sort(nulls[n])
+
+            # Compute the p-value by integrating the discrete tails directly.
+            # The high-end tail is stored reversed as _finalize expects.
+            group = tested & (sizes == n)
+            low = ((np.searchsorted(null, observed[group], side='right') + 1) /
+                   (null.size + 1))
+            high = ((null.size - np.searchsorted(null, observed[group], side='left') + 1) /
+                    (null.size + 1))
+            pvals[group] = np.where(low <= high, low, 1 - high)
         print()
-        return res
-
 
-def chi2_test(X, y, *, ddof=0, min_count=5):
-    x, y = _check_Xy(X, y)
-    f_exp = y.value_counts()
-    min_count = max(min_count, 5)
+    pvals[np.isnan(observed)] = np.nan
+    return _group_frame(x, [('count', counts), ('pval', pvals)], min_count)
 
-    def pval(grp, _f_exp=f_exp, _ddof=ddof):
-        if grp.size < min_count:
-            return np.nan
-        f_obs = grp.value_counts().reindex(_f_exp.index)
-        f_obs.fillna(0, inplace=True)
-        if not (f_obs >= 5).all():
-            return np.nan
-        return chisquare(f_obs.values, _f_exp.values, ddof=_ddof)[1]
 
-    if not (f_exp >= 5).all():
-        def pval(_):
-            return np.nan
+# Closed-form tests accept a `callback`, called with the number of done
+# and all batches of groups, and a `cancel_token` (see CancellationToken).
 
-    return _groupby_agg(x, y, pval, min_count=min_count)
+def chi2_test(X, y, *, ddof=0, min_count=5, **kwargs):
+    return _run_group_test(X, y, _Chi2Test, min_count, ddof=ddof, **kwargs)
 
 
-def hyper_test(X, y, *, min_count=5):
-    x, y = _check_Xy(X, y)
-    assert y.dtype == bool
-    min_count = max(min_count, 5)
+def hyper_test(X, y, *, min_count=5, **kwargs):
+    return _run_group_test(X, y, _HyperTest, min_count, **kwargs)
 
-    # N, n, K, k as in https://en.wikipedia.org/wiki/Hypergeometric_distribution#Definition
-    N, K = y.size, y.sum()
 
-    def pval(grp):
-        if grp.size < min_count:
-            return np.nan
-        return hypergeom(M=N, n=K, N=len(grp), loc=1).sf(x=grp.sum())
+def t_test(X, y, min_count=5, **kwargs):
+    return _run_group_test(X, y, _TTest, min_count, **kwargs)
 
-    def enrichment(grp):
-        return (grp.sum() / grp.size) / (K / N)
 
-    return _groupby_agg(x, y, ['sum', enrichment, pval], min_count=min_count)
+def fligner_killeen_test(X, y, min_count=5, **kwargs):
+    return _run_group_test(X, y, _FlignerTest, min_count, **kwargs)
 
 
-def t_test(X, y, min_count=5):
-    x, y = _check_Xy(X, y, norm_y=True)
-    min_count = max(min_count, 5)
-
-    def pval(grp, _popmean=y.mean()):
-        if grp.size < min_count:
-            return np.nan
-        return ttest_1samp(grp, popmean=_popmean, nan_policy='omit')[1]
-
-    return _groupby_agg(x, y, pval, min_count=min_count)
-
-
-def fligner_killeen_test(X, y, min_count=5):
-    x, y = _check_Xy(X, y, norm_y=True)
-    min_count = max(min_count, 5)
+def mannwhitneyu_test(X, y, min_count=5, **kwargs):
+    return _run_group_test(X, y, _MannWhitneyUTest, min_count, **kwargs)
 
-    def pval(grp):
-        if grp.size < min_count:
-            return np.nan
-        return fligner(grp.values, y.values)[1]
 
-    return _groupby_agg(x, y, pval, min_count=min_count)
+def gumbel_min_test(X, y, min_count=5, **kwargs):
+    return _run_group_test(X, y, _GumbelMinTest, min_count, **kwargs)
 
 
-def mannwhitneyu_test(X, y, min_count=20):
-    x, y = _check_Xy(X, y, norm_y=True)
-    min_count = max(min_count, 20)
+def gumbel_max_test(X, y, min_count=5, **kwargs):
+    return _run_group_test(X, y, _GumbelMaxTest, min_count, **kwargs)
 
-    def pval(grp, _y_sorted=y.sort_values().values):
-        if grp.size < min_count:
-            return np.nan
-        return mannwhitneyu(grp.values, _y_sorted)[1]
 
-    return _groupby_agg(x, y, pval, min_count=min_count)
+def multi_target_test(X, Y, *, test='t', min_count=5, callback=None,
+                      cancel_token=None, **kwargs):
+    """
+    Test groups given by X against each column of Y with one of
+    GROUP_TESTS. Other keyword arguments (e.g. `ddof` of the chi² test)
+    are passed to the test.
 
+    The groups are encoded once for all targets. The t, hypergeometric
+    and Gumbel tests are computed as matrix operations over all targets;
+    rows with a missing target value are skipped for that target only.
 
-def gumbel_min_test(X, y, min_count=5):
-    x, y = _check_Xy(X, y, norm_y=True)
-    min_count = max(min_count, 5)
-    return _groupby_agg(x, y, 'min', min_count=min_count,
-                        func=lambda df: df.__setitem__('pval', gumbel_l.cdf(df.pop('min').values)))
-
-
-def gumbel_max_test(X, y, min_count=5):
-    x, y = _check_Xy(X, y, norm_y=True)
-    min_count = max(min_count, 5)
-    return _groupby_agg(x, y, 'max', min_count=min_count,
-                        func=lambda df: df.__setitem__('pval', gumbel_r.cdf(df.pop('max').values)))
+    Returns a long-format frame like the individual tests with an
+    additional 'target' column; p-values are corrected per target.
+    """
+    if np.ndim(X) == 1:
+        X = pd.Series(X).to_frame()
+    X, Y = pd.DataFrame(X), pd.DataFrame(Y)
+    assert len(X) == len(Y)
+    test_cls = GROUP_TESTS[test]
+    min_count = max(min_count, test_cls.min_count)
+    if issubclass(test_cls, _SizePlannedTest):
+        kwargs.update(min_tested_count=min_count, cancel_token=cancel_token)
+
+    valid = ~X.isnull().any(axis=1).values
+    x = _GroupKeys(X[valid])
+    if not valid.all():
+        Y = Y[valid]
+    _check_cancelled(cancel_token)
+    columns = OrderedDict(test_cls.multi(Y, x.codes, x.n_groups, **kwargs))
+    _check_cancelled(cancel_token)
+    if callback:
+        callback(1, 1)
+
+    # Decode labels once, for groups large enough for any target, and
+    # lay out the results target by target
+    groups = np.flatnonzero((columns['count'] >= min_count).any(axis=1))
+    labels = x.labels(groups)
+    df = pd.DataFrame(
+        OrderedDict([('target', np.repeat(Y.columns.values, groups.size))] +
+                    [(name, values[groups].T.ravel())
+                     for name, values in columns.items()]),
+        index=pd.Index(labels * len(Y.columns), dtype=object, tupleize_cols=False))
+    n_tests = np.count_nonzero(columns['count'], axis=0)
+    return _finalize(df, x.name, min_count, n_tests=np.repeat(n_tests, groups.size))
+
+
+class GroupStatistics:
+    """
+    Mergeable per-group sufficient statistics of y: counts, means, sums
+    of squared deviations and extremes of numeric y, and class counts of
+    bool, categorical or object y (not of integers, which can have as many
+    distinct values as rows). They suffice for the t, hypergeometric, chi²
+    and Gumbel tests, so data can be tested chunk by chunk (see
+    `streaming_test`).
+
+    Groups are identified by their labels, which are tuples of values of
+    X's columns, so chunks needn't contain the same groups. Means and
+    sums of squares are merged with the pairwise (Chan et al.) update.
+    """
+    def __init__(self):
+        self.name = None
+        self._index = {}    # group label -> group index
+        self._labels = []
+        self._classes = {}  # class value -> class index
+        self.count = np.zeros(0, dtype=int)
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+        self.min = np.zeros(0)
+        self.max = np.zeros(0)
+        self.table = np.zeros((0, 0), dtype=int)
+        self.numeric = True
+
+    @property
+    def n_groups(self):
+        return len(self._labels)
+
+    def labels(self, groups=None):
+        return self._labels if groups is None else [self._labels[i] for i in groups]
+
+    def _group_indices(self, labels):
+        for label in labels:
+            if label not in self._index:
+                self._index[label] = len(self._labels)
+                self._labels.append(label)
+        n_new = self.n_groups - self.count.size
+        if n_new:
+            self.count = np.r_[self.count, np.zeros(n_new, dtype=int)]
+            self.mean = np.r_[self.mean, np.zeros(n_new)]
+            self.m2 = np.r_[self.m2, np.zeros(n_new)]
+            self.min = np.r_[self.min, np.full(n_new, np.inf)]
+            self.max = np.r_[self.max, np.full(n_new, -np.inf)]
+            self.table = np.vstack((self.table,
+                                    np.zeros((n_new, self.table.shape[1]), dtype=int)))
+        return np.array([self._index[label] for label in labels], dtype=int)
+
+    def _class_indices(self, classes):
+        for value in classes:
+            self._classes.setdefault(value, len(self._classes))
+        n_new = len(self._classes) - self.table.shape[1]
+        if n_new:
+            self.table = np.hstack((self.table,
+                                    np.zeros((self.table.shape[0], n_new), dtype=int)))
+        return np.array([self._classes[value] for value in classes], dtype=int)
+
+    def _merge(self, groups, count, mean, m2, minimum, maximum, table, classes):
+        n_a, n_b = self.count[groups], count
+        n = n_a + n_b
+        delta = mean - self.mean[groups]
+        self.mean[groups] += delta * n_b / n
+        self.m2[groups] += m2 + delta**2 * n_a * n_b / n
+        self.count[groups] = n
+        self.min[groups] = np.fmin(self.min[groups], minimum)
+        self.max[groups] = np.fmax(self.max[groups], maximum)
+        if table is not None:
+            classes = self._class_indices(classes)
+            self.table[np.ix_(groups, classes)] += table
+
+    def update(self, X, y):
+        """Add a chunk of rows; rows with missing values are skipped"""
+        if self.name is None:
+            self.name = tuple(pd.DataFrame(X).columns) if np.ndim(X) == 2 else (0,)
+        x, y = _check_Xy(X, y)
+        codes, n_groups = x.codes, x.n_groups
+        groups = self._group_indices(x.labels())
+
+        self.numeric = self.numeric and is_numeric_dtype(y)
+        count = np.bincount(codes, minlength=n_groups)
+        if self.numeric:
+            values = np.asarray(y, dtype=float)
+            _, mean, m2 = _group_moments(codes, values, n_groups)
+            minimum = _group_reduce(np.minimum, values, codes, n_groups)
+            maximum = _group_reduce(np.maximum, values, codes, n_groups)
+        else:
+            mean = m2 = np.zeros(n_groups)
+            minimum, maximum = np.full(n_groups, np.nan), np.full(n_groups, np.nan)
+        table = classes = None
+        if is_bool_dtype(y) or not is_numeric_dtype(y):
+            class_codes, classes = pd.factorize(y)
+            table = np.bincount(codes * len(classes) + class_codes,
+                                minlength=n_groups * len(classes))
+            table = table.reshape(n_groups, len(classes))
+        self._merge(groups, count, mean, m2, minimum, maximum, table, classes)
+        return self
+
+    def merge(self, other):
+        """Merge statistics of another (e.g. separately computed) instance"""
+        if self.name is None:
+            self.name = other.name
+        self.numeric = self.numeric and other.numeric
+        classes = sorted(other._classes, key=other._classes.get)
+        self._merge(self._group_indices(other._labels), other.count, other.mean,
+                    other.m2, other.min, other.max,
+                    other.table if classes else None, classes)
+        return self
+
+    def _population_moments(self):
+        N = self.count.sum()
+        mean = (self.count * self.mean).sum() / N
+        m2 = (self.m2 + self.count * (self.mean - mean)**2).sum()
+        return N, mean, m2
+
+    def test(self, test='t', *, min_count=5, ddof=0):
+        """Return results of a test, like the corresponding *_test function"""
+        if test == 't':
+            assert self.numeric
+            _, popmean, _ = self._population_moments()
+            columns = [('count', self.count),
+                       ('pval', _t_pval(self.count, self.mean, self.m2, popmean))]
+        elif test in ('gumbel_min', 'gumbel_max'):
+            assert self.numeric
+            N, mean, m2 = self._population_moments()
+            extreme, dist = ((self.min, gumbel_l) if test == 'gumbel_min' else
+                             (self.max, gumbel_r))
+            columns = [('count', self.count),
+                       ('pval', dist.cdf((extreme - mean) / np.sqrt(m2 / (N - 1))))]
+        elif test == 'chi2':
+            assert self._classes
+            columns = _Chi2Test.from_table(self.table, self.table.sum(axis=0), ddof)
+        elif test == 'hyper':
+            assert self._classes and set(self._classes) <= {False, True}
+            k = (self.table[:, self._classes[True]] if True in self._classes else
+                 np.zeros(self.n_groups, dtype=int))
+            columns = _HyperTest.from_counts(self.count, k, self.count.sum(), k.sum())
+        else:
+            raise ValueError('Test {!r} needs full data'.format(test))
+
+        # Order groups like other tests do
+        return _group_frame(self, columns, min_count).sort_index()
+
+
+def streaming_test(chunks, *, test='t', min_count=5, ddof=0):
+    """
+    Test groups from an iterable of (X, y) chunks, e.g. read from a large
+    file piece by piece, with the t (`test='t'`), hypergeometric,
+    chi² or Gumbel test. Only per-group sufficient statistics are kept
+    in memory. The result is the same as of the test on concatenated
+    chunks.
+    """
+    stats = GroupStatistics()
+    for X, y in chunks:
+        stats.update(X, y)
+    return stats.test(test, min_count=min_count, ddof=ddof)
+
+
+def _split_groups(rows, codes, labels, column, n_values, min_count):
+    """
+    Split groups (given by `codes` of `rows`) by values of `column`
+    (integer codes below `n_values`, -1 for missing) and keep subgroups
+    with at least `min_count` rows. Return their rows, codes and labels:
+    rows of value codes of parent's columns and the new column.
+    """
+    values = column[rows]
+    known = values >= 0
+    if not known.all():
+        rows, codes, values = rows[known], codes[known], values[known]
+    keys = codes * n_values + values
+    frequent = np.bincount(keys) >= min_count
+    subgroups = np.flatnonzero(frequent)
+    labels = np.column_stack((labels[subgroups // n_values], subgroups % n_values))
+    new_codes = np.cumsum(frequent) - 1
+    if subgroups.size < frequent.size:
+        keep = frequent[keys]
+        rows, keys = rows[keep], keys[keep]
+    return rows, new_codes[keys], labels
+
+
+def subgroup_search(X, y, *, test='t', max_depth=3, min_count=5,
+                    callback=None, cancel_token=None, **kwargs):
+    """
+    Test all subgroups defined by values of up to `max_depth` columns of X.
+
+    Combinations of columns are enumerated Apriori-style: subgroups of
+    k + 1 columns are made by splitting the rows of each k-column subgroup
+    by another column, and only subgroups with at least `min_count` rows
+    are kept (and split further), since no split can have a larger count.
+    The enumeration is depth-first to keep memory bounded. Surviving
+    subgroups of each column set are tested with one of GROUP_TESTS at once.
+
+    Returns a frame like the individual tests, indexed by tuples of
+    values of all columns of X, with None for columns not in the subgroup.
+    Cancellation is checked after each column set; `callback` is called
+    with the number of done and all first columns of column sets.
+    """
+    if np.ndim(X) == 1:
+        X = pd.Series(X).to_frame()
+    X = pd.DataFrame(X)
+    assert len(X) == len(y)
+    test_cls = GROUP_TESTS[test]
+    min_count = max(min_count, test_cls.min_count)
+
+    y = pd.Series(y).reset_index(drop=True)
+    valid = y.notnull().values
+    y = _check_y(y[valid], norm_y=test_cls.norm_y)
+    if issubclass(test_cls, _SizePlannedTest):
+        kwargs.update(min_tested_count=min_count, cancel_token=cancel_token)
+    group_test = test_cls(y, **kwargs)
+
+    factorized = [pd.factorize(X[col].values[valid]) for col in X.columns]
+    columns = [codes for codes, _ in factorized]
+    n_values = [max(len(uniques), 1) for _, uniques in factorized]
+
+    results, labels = [], []
+
+    def search(column_set, rows, codes, group_labels):
+        for col in range(column_set[-1] + 1 if column_set else 0, len(columns)):
+            sub_rows, sub_codes, sub_labels = _split_groups(
+                rows, codes, group_labels, columns[col], n_values[col], min_count)
+            if not len(sub_labels):
+                continue
+            sub_set = column_set + (col,)
+            # All subgroups of a column set are tested in one vectorized call
+            results.append(group_test(sub_codes, len(sub_labels), rows=sub_rows))
+            label = np.full((len(sub_labels), len(columns)), None, dtype=object)
+            for i, c in enumerate(sub_set):
+                label[:, c] = factorized[c][1][sub_labels[:, i]]
+            labels.extend(map(tuple, label))
+            _check_cancelled(cancel_token)
+            if len(sub_set) < max_depth:
+                search(sub_set, sub_rows, sub_codes, sub_labels)
+            if callback and not column_set:
+                callback(col + 1, len(columns))
+
+    search((), np.arange(len(y)), np.zeros(len(y), dtype=int),
+           np.zeros((1, 0), dtype=int))
+
+    names = [name for name, _ in results[0]] if results else ['count', 'pval']
+    df = pd.DataFrame(
+        OrderedDict((name, np.concatenate([dict(result)[name] for result in results])
+                     if results else [])
+                    for name in names),
+        index=pd.Index(labels, dtype=object, tupleize_cols=False))
+    return _finalize(df, tuple(X.columns), min_count)
 
 
 if __name__ == '__main__':
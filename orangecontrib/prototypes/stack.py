@@ -1,38 +1,137 @@
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.model_selection import (
+    KFold, StratifiedKFold, ShuffleSplit, StratifiedShuffleSplit
+)
 
 from Orange.base import Learner, Model
 from Orange.modelling import Fitter
 from Orange.classification import LogisticRegressionLearner
 from Orange.classification.base_classification import LearnerClassification
 from Orange.data import Domain, ContinuousVariable, Table
-from Orange.evaluation import CrossValidation
 from Orange.regression import RidgeRegressionLearner
 from Orange.regression.base_regression import LearnerRegression
 
 
 __all__ = ['StackedLearner', 'StackedClassificationLearner',
-           'StackedRegressionLearner', 'StackedFitter']
+           'StackedRegressionLearner', 'StackedFitter', 'BaseFitCache']
 
 
 class StackedModel(Model):
-    def __init__(self, models, aggregate, use_prob=True):
+    """
+    Stacked model. Each of `models` is a base model or a list of models
+    (e.g. fit on folds of cross-validation) whose outputs are averaged.
+
+    Data is predicted in chunks of `batch_size` rows; base models are
+    evaluated in `n_jobs` threads (as in joblib; StackedLearner passes its
+    own). Meta-features of a chunk are written directly into a table in
+    the aggregator's domain, so the input data is never transformed or
+    copied as a whole.
+    """
+    # Defaults for models pickled without these attributes
+    batch_size = 100000
+    n_jobs = 1
+
+    def __init__(self, models, aggregate, use_prob=True, n_jobs=1,
+                 batch_size=100000):
         self.models = models
         self.aggregate = aggregate
         self.use_prob = use_prob
+        self.n_jobs = n_jobs
+        self.batch_size = batch_size
+        self.pruned = []
+        self.meta_data = None
+        self.time_saved = 0.
+
+    def _base_output(self, model, data):
+        if isinstance(model, (list, tuple)):
+            return np.mean([self._base_output(m, data) for m in model], axis=0)
+        return model(data, Model.Probs) if self.use_prob else model(data)
+
+    def _meta_features(self, data, map_=map):
+        """Array of the aggregator's attributes, i.e. (concatenated)
+        outputs of base models"""
+        X = np.empty((len(data), len(self.aggregate.domain.attributes)))
+        width = X.shape[1] // len(self.models)
+        outputs = map_(partial(self._base_output, data=data), self.models)
+        for i, output in enumerate(outputs):
+            X[:, i * width:(i + 1) * width] = np.reshape(output, (len(data), width))
+        return X
 
     def predict_storage(self, data):
+        n_jobs = min(effective_n_jobs(self.n_jobs), len(self.models))
+        executor = ThreadPoolExecutor(n_jobs) if n_jobs > 1 else None
+        try:
+            values, probs = [], []
+            for start in range(0, max(len(data), 1), self.batch_size):
+                chunk = (data if len(data) <= self.batch_size else
+                         data[start:start + self.batch_size])
+                X = self._meta_features(chunk, executor.map if executor else map)
+                stacked_data = Table.from_numpy(self.aggregate.domain, X,
+                                                np.full(len(X), np.nan))
+                if self.use_prob:
+                    value, prob = self.aggregate(stacked_data, Model.ValueProbs)
+                    values.append(value)
+                    probs.append(prob)
+                else:
+                    values.append(self.aggregate(stacked_data, Model.Value))
+        finally:
+            if executor is not None:
+                executor.shutdown()
         if self.use_prob:
-            probs = [m(data, Model.Probs) for m in self.models]
-            X = np.hstack(probs)
-        else:
-            pred = [m(data) for m in self.models]
-            X = np.column_stack(pred)
-        Y = np.repeat(np.nan, X.shape[0])
-        stacked_data = data.transform(self.aggregate.domain)
-        stacked_data.X = X
-        stacked_data.Y = Y
-        return self.aggregate(
-            stacked_data, Model.ValueProbs if self.use_prob else Model.Value)
+            return np.concatenate(values), np.vstack(probs)
+        return np.concatenate(values)
+
+
+def _fit_predict(learner, data, train=None, test=None, use_prob=True,
+                 return_model=False):
+    """Fit learner on train rows of data (all if None) and return the model
+    or, if test rows are given, its predictions for them (with the model
+    if `return_model`)"""
+    model = learner(data if train is None else data[train])
+    if test is None:
+        return model
+    test_data = data[test]
+    pred = model(test_data, Model.Probs) if use_prob else model(test_data)
+    return (model, pred) if return_model else pred
+
+
+class BaseFitCache:
+    """
+    Cache of out-of-fold predictions and fitted models of base learners,
+    so that changing the aggregator of a StackedLearner (or adding a base
+    learner) doesn't repeat the cross-validation of the others.
+
+    Entries are keyed by the learner's identity (learner objects are
+    replaced when their parameters change), the data checksum and the
+    splitting parameters. At most `max_size` entries are kept; least
+    recently used ones are evicted.
+    """
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, learner, key):
+        entry = self._entries.get((id(learner), key))
+        # Check identity since ids of deleted learners are reused
+        if entry is None or entry[0] is not learner:
+            return None
+        self._entries.move_to_end((id(learner), key))
+        return entry[1]
+
+    def put(self, learner, key, value):
+        self._entries[(id(learner), key)] = (learner, value)
+        self._entries.move_to_end((id(learner), key))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
 
 
 class StackedLearner(Learner):
@@ -41,7 +140,9 @@ class StackedLearner(Learner):
     over the results of base models.
 
     K-fold cross-validation is used to get predictions of the base learners
-    and fit the aggregator to obtain a stacked model.
+    and fit the aggregator to obtain a stacked model. Alternatively
+    (blending), base learners are fit once on a training split and the
+    aggregator is fit on their predictions for the held-out rest.
 
     Args:
         learners (list):
@@ -54,36 +155,242 @@ class StackedLearner(Learner):
         k (int):
             number of folds for cross-validation
 
+        n_jobs (int):
+            number of processes in which fits of base learners on folds
+            and on the whole data run (as in joblib; 1 runs them in
+            this process), and of threads in which the stacked model
+            evaluates base models
+
+        random_state (int):
+            seed for the (stratified) split into folds
+
+        refit (bool):
+            if True, base learners are refit on the whole data; otherwise
+            the stacked model keeps the k models of each learner fit in
+            cross-validation and averages their predictions
+            ("CV-bagging"), which saves one fit per learner. With
+            blending, the models fit on the training split are kept.
+
+        holdout (float or None):
+            if set, the proportion of data held out for fitting the
+            aggregator (blending) instead of cross-validation
+
+        cache (BaseFitCache or None):
+            cache of base learners' predictions and models, which can be
+            shared by stacked learners with different aggregators
+
+        prune (float or None):
+            if set, base models whose share of the aggregator's total
+            weight is below this value are dropped and the aggregator is
+            refit on the rest; weights are absolute coefficients of linear
+            aggregators or else permutation importances
+
+        levels (list):
+            list of lists of `Learner`s for intermediate meta levels; each
+            level is stacked (with k-fold cross-validation) on the
+            out-of-fold predictions of the previous one and `aggregate`
+            is fit on the predictions of the last level
+
+        keep_meta_data (bool):
+            if True, the out-of-fold predictions of base learners, with the
+            class and metas of the data, are kept in the model's
+            `meta_data` table (otherwise None), e.g. to stack them again
+            without refitting base learners; the table takes as much
+            memory as n_rows x n_learners (x n_classes) floats plus a copy
+            of the class and metas
+
     Returns:
         instance of StackedModel
     """
 
     __returns__ = StackedModel
 
-    def __init__(self, learners, aggregate, k=5, preprocessors=None):
+    def __init__(self, learners, aggregate, k=5, preprocessors=None,
+                 n_jobs=1, random_state=0, refit=True, holdout=None,
+                 cache=None, prune=None, levels=(), keep_meta_data=False):
         super().__init__(preprocessors=preprocessors)
         self.learners = learners
         self.aggregate = aggregate
         self.k = k
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.refit = refit
+        self.holdout = holdout
+        self.cache = cache
+        self.prune = prune
+        self.levels = levels
+        self.keep_meta_data = keep_meta_data
         self.params = vars()
 
-    def fit_storage(self, data):
-        res = CrossValidation(data, self.learners, k=self.k)
-        if data.domain.class_var.is_discrete:
-            X = np.hstack(res.probabilities)
-            use_prob = True
+    def _folds(self, data):
+        """List of (train, test) row indices of k folds or of the holdout
+        split, stratified by discrete class if each class has at least
+        k (or two) instances"""
+        class_var = data.domain.class_var
+        stratify = class_var.is_discrete and \
+            np.bincount(data.Y.astype(int), minlength=len(class_var.values))\
+            .min() >= (2 if self.holdout else self.k)
+        if self.holdout:
+            splitter = (StratifiedShuffleSplit if stratify else ShuffleSplit)(
+                1, test_size=self.holdout, random_state=self.random_state)
         else:
-            X = res.predicted.T
-            use_prob = False
+            splitter = (StratifiedKFold if stratify else KFold)(
+                self.k, shuffle=True, random_state=self.random_state)
+        return list(splitter.split(data.X, data.Y))
+
+    def _fit_base(self, data, learners, folds, rows, use_prob):
+        """Return out-of-fold predictions for `rows` and the model (or fold
+        models) of each learner"""
+        # All (learner, fold) fits and the final fits on the whole data
+        # are independent; results come back in the order of tasks
+        tasks = [(learner, train, test)
+                 for learner in learners for train, test in folds]
+        if self.refit:
+            tasks += [(learner, None, None) for learner in learners]
+        results = Parallel(n_jobs=self.n_jobs)(
+            delayed(_fit_predict)(learner, data, train, test, use_prob,
+                                  return_model=not self.refit)
+            for learner, train, test in tasks)
+
+        n_folds = len(folds)
+        fitted = []
+        for i in range(len(learners)):
+            pred, models = None, []
+            for (_, test), result in zip(folds, results[i * n_folds:(i + 1) * n_folds]):
+                if not self.refit:
+                    model, result = result
+                    models.append(model)
+                if pred is None:
+                    pred = np.empty((len(data),) + result.shape[1:])
+                pred[test] = result
+            if self.refit:
+                models = results[len(learners) * n_folds + i]
+            fitted.append((pred[rows], models))
+        return fitted
+
+    def fit_storage(self, data):
+        # Rows without a class can be neither split into (stratified)
+        # folds nor used to fit the aggregator
+        known = ~np.isnan(data.Y)
+        if not known.all():
+            data = data[known]
+        use_prob = data.domain.class_var.is_discrete
+        folds = self._folds(data)
+        # Out-of-fold predictions are in the order of rows of data; with
+        # blending, only the held-out rows have them
+        rows = np.sort(np.concatenate([test for _, test in folds]))
+
+        fitted = [None] * len(self.learners)
+        if self.cache is not None:
+            key = (data.checksum(), self.k, self.holdout, self.random_state,
+                   self.refit)
+            fitted = [self.cache.get(learner, key) for learner in self.learners]
+        missing = [i for i, entry in enumerate(fitted) if entry is None]
+        new = self._fit_base(data, [self.learners[i] for i in missing],
+                             folds, rows, use_prob)
+        for i, entry in zip(missing, new):
+            fitted[i] = entry
+            if self.cache is not None:
+                self.cache.put(self.learners[i], key, entry)
+
+        predictions = [pred for pred, _ in fitted]
+        models = [models for _, models in fitted]
+        X = np.hstack(predictions) if use_prob else np.column_stack(predictions)
+
+        if rows.size < len(data):
+            data = data[rows]
         dom = Domain([ContinuousVariable('f{}'.format(i + 1))
                       for i in range(X.shape[1])],
                      data.domain.class_var)
         stacked_data = data.transform(dom)
         stacked_data.X = X
-        stacked_data.Y = res.actual
-        models = [l(data) for l in self.learners]
-        aggregate_model = self.aggregate(stacked_data)
-        return StackedModel(models, aggregate_model, use_prob=use_prob)
+        stacked_data.Y = data.Y
+        aggregate_model = self._fit_aggregate(stacked_data)
+        model = StackedModel(models, aggregate_model, use_prob=use_prob,
+                             n_jobs=self.n_jobs)
+        if self.prune is not None:
+            model = self._prune(model, stacked_data, data)
+        if self.keep_meta_data:
+            # Only outputs of base models that weren't pruned
+            width = X.shape[1] // len(models)
+            kept = np.repeat(~np.isin(np.arange(len(models)), model.pruned), width)
+            model.meta_data = Table.from_numpy(
+                Domain([var for var, k in zip(dom.attributes, kept) if k],
+                       data.domain.class_vars, data.domain.metas),
+                X[:, kept], data.Y, data.metas,
+                data.W if data.has_weights() else None, ids=data.ids)
+        return model
+
+    def _fit_aggregate(self, stacked_data):
+        if not self.levels:
+            return self.aggregate(stacked_data)
+        # The next level is a stacked model on meta-features
+        return StackedLearner(
+            self.levels[0], self.aggregate, k=self.k, n_jobs=self.n_jobs,
+            random_state=self.random_state, refit=self.refit,
+            cache=self.cache, prune=self.prune, levels=self.levels[1:]
+        )(stacked_data)
+
+    @staticmethod
+    def _weights(model, stacked_data):
+        """Share of each base model in the aggregator's total weight"""
+        n_columns = stacked_data.X.shape[1]
+        width = n_columns // len(model.models)
+        coefficients = getattr(model.aggregate, 'coefficients', None)
+        if coefficients is not None:
+            coefficients = np.atleast_2d(np.asarray(coefficients, dtype=float))
+        if coefficients is not None and coefficients.shape[1] == n_columns:
+            weights = np.abs(coefficients).sum(axis=0)
+        else:
+            # Mean change of the aggregator's output when the model's
+            # outputs are permuted among rows
+            rng = np.random.RandomState(0)
+            ret = Model.Probs if model.use_prob else Model.Value
+            output = model.aggregate(stacked_data, ret)
+            weights = np.zeros(n_columns)
+            for i in range(len(model.models)):
+                cols = slice(i * width, (i + 1) * width)
+                permuted = stacked_data.copy()
+                with permuted.unlocked(permuted.X):
+                    permuted.X[:, cols] = \
+                        permuted.X[rng.permutation(len(permuted)), cols]
+                change = np.abs(model.aggregate(permuted, ret) - output)
+                weights[cols] = change.mean() / width
+        weights = weights.reshape(len(model.models), width).sum(axis=1)
+        total = weights.sum()
+        return weights / total if total else np.full(len(weights), 1 / len(weights))
+
+    def _prune(self, model, stacked_data, data):
+        """Drop base models with a low weight and refit the aggregator.
+        Indices of dropped models and the estimated share of inference
+        time they took are stored in `pruned` and `time_saved`."""
+        weights = self._weights(model, stacked_data)
+        keep = weights >= self.prune
+        keep[np.argmax(weights)] = True
+        if keep.all():
+            return model
+
+        width = stacked_data.X.shape[1] // len(model.models)
+        columns = np.repeat(keep, width)
+        dom = Domain([var for var, kept
+                      in zip(stacked_data.domain.attributes, columns) if kept],
+                     stacked_data.domain.class_var)
+        pruned = StackedModel(
+            [m for m, kept in zip(model.models, keep) if kept],
+            self._fit_aggregate(stacked_data.transform(dom)),
+            use_prob=model.use_prob, n_jobs=model.n_jobs,
+            batch_size=model.batch_size)
+
+        sample = data[:1000]
+        times = []
+        for base_model in model.models:
+            t = time.perf_counter()
+            model._base_output(base_model, sample)
+            times.append(time.perf_counter() - t)
+        times = np.array(times)
+        pruned.pruned = np.flatnonzero(~keep).tolist()
+        pruned.time_saved = times[~keep].sum() / times.sum()
+        return pruned
 
 
 class StackedClassificationLearner(StackedLearner, LearnerClassification):
@@ -95,8 +402,13 @@ class StackedClassificationLearner(StackedLearner, LearnerClassification):
     """
 
     def __init__(self, learners, aggregate=LogisticRegressionLearner(), k=5,
-                 preprocessors=None):
-        super().__init__(learners, aggregate, k=k, preprocessors=preprocessors)
+                 preprocessors=None, n_jobs=1, random_state=0, refit=True,
+                 holdout=None, cache=None, prune=None, levels=(),
+                 keep_meta_data=False):
+        super().__init__(learners, aggregate, k=k, preprocessors=preprocessors,
+                         n_jobs=n_jobs, random_state=random_state, refit=refit,
+                         holdout=holdout, cache=cache, prune=prune,
+                         levels=levels, keep_meta_data=keep_meta_data)
 
 
 class StackedRegressionLearner(StackedLearner, LearnerRegression):
@@ -107,8 +419,13 @@ class StackedRegressionLearner(StackedLearner, LearnerRegression):
     regression-specific aggregator (`RidgeRegressionLearner`).
     """
     def __init__(self, learners, aggregate=RidgeRegressionLearner(), k=5,
-                 preprocessors=None):
-        super().__init__(learners, aggregate, k=k, preprocessors=preprocessors)
+                 preprocessors=None, n_jobs=1, random_state=0, refit=True,
+                 holdout=None, cache=None, prune=None, levels=(),
+                 keep_meta_data=False):
+        super().__init__(learners, aggregate, k=k, preprocessors=preprocessors,
+                         n_jobs=n_jobs, random_state=random_state, refit=refit,
+                         holdout=holdout, cache=cache, prune=prune,
+                         levels=levels, keep_meta_data=keep_meta_data)
 
 
 class StackedFitter(Fitter):
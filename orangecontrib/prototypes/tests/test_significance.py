@@ -0,0 +1,469 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.stats import ttest_1samp, mannwhitneyu, fligner, hypergeom
+
+from orangecontrib.prototypes import significance
+from orangecontrib.prototypes.significance import (
+    perm_test, t_test, mannwhitneyu_test, fligner_killeen_test, hyper_test,
+    chi2_test, gumbel_max_test, subgroup_search, multi_target_test,
+    streaming_test, GroupStatistics, NullDistributionCache, PVALUE_LABEL,
+    Cancelled, CancellationToken, patch, correction_benjamini_hochberg,
+    correction_bonferroni, _GroupKeys,
+)
+
+
+def _two_tailed(pvals):
+    pvals = np.asarray(pvals)
+    return np.where(pvals < .5, pvals, 1 - pvals)
+
+
+class TestPermTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rs = np.random.RandomState(0)
+        n = 200
+        # Group 'B' is shifted upwards, 'A' and 'C' are not
+        cls.X = np.array(list('A' * n + 'B' * n + 'C' * n))
+        cls.y = np.r_[rs.normal(size=n), rs.normal(1, size=n), rs.normal(size=n)]
+
+    def test_statistics(self):
+        for statistic in ('mean', 'median'):
+            res = perm_test(self.X, self.y, statistic=statistic, seed=0)
+            self.assertEqual(len(res), 3)
+            pvals = res[PVALUE_LABEL]
+            self.assertLess(pvals[('B',)], .01)
+
+    def test_chi2(self):
+        res = perm_test(self.X, self.y > .5, statistic='chi2', seed=0)
+        pvals = res[PVALUE_LABEL]
+        self.assertLess(pvals[('B',)], .01)
+        self.assertTrue((pvals <= .5).all())
+
+    def test_nested_sampling(self):
+        X = np.r_[self.X, ['D'] * 50]
+        y = np.r_[self.y, np.random.RandomState(1).normal(size=50)]
+        for statistic in ('mean', 'var', 'min', 'max', 'median', 'chi2'):
+            yy = y > .5 if statistic == 'chi2' else y
+            res1 = perm_test(X, yy, statistic=statistic, seed=0)
+            res2 = perm_test(X, yy, statistic=statistic, seed=0, sampling='nested')
+            self.assertEqual(list(res1.index), list(res2.index))
+            np.testing.assert_allclose(res1[PVALUE_LABEL], res2[PVALUE_LABEL],
+                                       atol=.1)
+
+    def test_custom_statistic(self):
+        res = perm_test(self.X, self.y, statistic=lambda s: s.quantile(.75),
+                        n_iter=50, seed=0)
+        self.assertLess(res[PVALUE_LABEL][('B',)], .05)
+
+    def test_segment_statistics(self):
+        rs = np.random.RandomState(2)
+        values = rs.normal(size=40)
+        classes = rs.randint(0, 3, 40)
+        bounds = np.array([0, 5, 5, 6, 18, 40])
+        statistics = [(significance.PERM_TEST_STATISTICS[name](), values)
+                      for name in significance.PERM_TEST_STATISTICS]
+        statistics += [(significance._PermTestChi2(classes), classes),
+                       (significance._PermTestCustom(lambda s: s.quantile(.75)), values)]
+        for statistic, y in statistics:
+            expected = [statistic(y[np.newaxis, start:end])[0] if end > start else np.nan
+                        for start, end in zip(bounds[:-1], bounds[1:])]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                np.testing.assert_allclose(statistic.segments(y, bounds), expected)
+
+    def test_seed(self):
+        res1 = perm_test(self.X, self.y, seed=1, n_jobs=1)
+        res2 = perm_test(self.X, self.y, seed=1, n_jobs=2)
+        np.testing.assert_equal(res1.values, res2.values)
+
+    def test_processes_backend(self):
+        for statistic in ('mean', 'chi2'):
+            y = self.y > .5 if statistic == 'chi2' else self.y
+            res1 = perm_test(self.X, y, statistic=statistic, seed=1)
+            res2 = perm_test(self.X, y, statistic=statistic, seed=1,
+                             backend='processes', n_jobs=2)
+            np.testing.assert_equal(res1.values, res2.values)
+
+        # No group is large enough to be tested, so no pool is needed
+        res = perm_test(self.X, self.y, seed=1, min_count=500,
+                        backend='processes', n_jobs=2)
+        self.assertEqual(len(res), 0)
+
+    def test_null_cache(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = NullDistributionCache(path)
+            for sampling in ('independent', 'nested'):
+                progress = []
+                res1 = perm_test(self.X, self.y, seed=0, null_cache=cache,
+                                 sampling=sampling)
+                res2 = perm_test(self.X, self.y, seed=0, null_cache=cache,
+                                 sampling=sampling,
+                                 callback=lambda *args: progress.append(args))
+                np.testing.assert_equal(res1.values, res2.values)
+                # Nothing left to sample
+                self.assertEqual(progress, [])
+
+            # Both samplings draw the same samples for a single group size
+            self.assertEqual(len(os.listdir(path)), 1)
+            perm_test(self.X, self.y, seed=1, null_cache=cache)
+            self.assertEqual(len(os.listdir(path)), 2)
+
+    def test_null_cache_processes(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = NullDistributionCache(path)
+            res1 = perm_test(self.X, self.y, seed=0, null_cache=cache,
+                             backend='processes', n_jobs=2)
+            # All nulls are cached, so no worker processes are needed
+            res2 = perm_test(self.X, self.y, seed=0, null_cache=cache,
+                             backend='processes', n_jobs=2)
+            np.testing.assert_equal(res1.values, res2.values)
+
+    def test_null_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as path:
+            # Room for three entries
+            cache = NullDistributionCache(path, max_size=3000)
+            for i in range(3):
+                cache.put(i, np.zeros(100))
+                os.utime(cache._filename(i), (i, i))
+            self.assertIsNotNone(cache.get(1))
+            cache.put(3, np.zeros(100))
+            cache.put(4, np.zeros(100))
+            self.assertIsNone(cache.get(0))
+            self.assertIsNone(cache.get(2))
+            for i in (1, 3, 4):
+                self.assertIsNotNone(cache.get(i))
+
+    def test_early_stopping(self):
+        for sampling in ('independent', 'nested'):
+            progress = []
+            res = perm_test(self.X, self.y, seed=0, n_iter=1000, early_stopping=10,
+                            sampling=sampling,
+                            callback=lambda *args: progress.append(args))
+            full = perm_test(self.X, self.y, seed=0, n_iter=1000, sampling=sampling)
+            np.testing.assert_allclose(res[PVALUE_LABEL], full[PVALUE_LABEL], atol=.1)
+            self.assertLess(res[PVALUE_LABEL][('B',)], .01)
+            # Significant groups don't stop early
+            self.assertEqual(progress[-1], (1000, 1000))
+            # Exceedances counted in small blocks of samples
+            with patch(significance, '_MAX_CHUNK_ELEMENTS', 10):
+                blocks = perm_test(self.X, self.y, seed=0, n_iter=1000, early_stopping=10,
+                                   sampling=sampling)
+            pd.testing.assert_frame_equal(blocks, res)
+
+    def test_early_stopping_processes(self):
+        pools = []
+
+        class Executor(ProcessPoolExecutor):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                pools.append(self)
+
+        expected = perm_test(self.X, self.y, seed=0, n_iter=1000, early_stopping=10)
+        with patch(significance, 'ProcessPoolExecutor', Executor):
+            res = perm_test(self.X, self.y, seed=0, n_iter=1000, early_stopping=10,
+                            backend='processes', n_jobs=2)
+        pd.testing.assert_frame_equal(res, expected)
+        # One pool for all rounds of sampling
+        self.assertEqual(len(pools), 1)
+
+    def test_cancel(self):
+        for n_jobs in (1, 2):
+            token = CancellationToken()
+            progress = []
+
+            def callback(n_done, n_all):
+                progress.append(n_done)
+                token.cancel()
+
+            with patch(significance, '_MAX_BATCH_ELEMENTS', 20000), \
+                    self.assertRaises(Cancelled):
+                perm_test(self.X, self.y, n_iter=5000, seed=0, n_jobs=n_jobs,
+                          callback=callback, cancel_token=token)
+            # Cancelled after the first completed batch
+            self.assertEqual(progress, [1])
+
+    def test_callback(self):
+        progress = []
+        perm_test(self.X, self.y, seed=0, callback=lambda *args: progress.append(args))
+        self.assertEqual(progress[-1][0], progress[-1][1])
+
+
+class TestClosedFormTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rs = np.random.RandomState(0)
+        n = 1000
+        cls.X = rs.randint(0, 10, n)
+        cls.y = rs.normal(size=n) + (cls.X == 3) * .5 + (cls.X == 4) * rs.normal(size=n)
+        cls.groups = [cls.X == i for i in range(10)]
+
+    def assert_pvals_equal(self, res, expected, two_sided=False, **kwargs):
+        # Rank tests report two-sided p-values, which aren't reversed
+        self.assertEqual(list(res.index), [(i,) for i in range(10)])
+        np.testing.assert_allclose(
+            res[PVALUE_LABEL], expected if two_sided else _two_tailed(expected), **kwargs)
+
+    def test_t_test(self):
+        y = (self.y - self.y.mean()) / self.y.std()
+        self.assert_pvals_equal(
+            t_test(self.X, self.y),
+            [ttest_1samp(y[g], y.mean())[1] for g in self.groups])
+
+    def test_mannwhitneyu_test(self):
+        for y in (self.y, self.y.round(1)):
+            self.assert_pvals_equal(
+                mannwhitneyu_test(self.X, y),
+                [mannwhitneyu(y[g], y)[1] for g in self.groups], two_sided=True)
+
+    def test_batches(self):
+        progress = []
+        expected = t_test(self.X, self.y, callback=lambda *args: progress.append(args))
+        self.assertEqual(progress, [(1, 1)])
+        progress = []
+        with patch(significance, '_MAX_BATCH_ROWS', 300):
+            res = t_test(self.X, self.y, callback=lambda *args: progress.append(args))
+            pd.testing.assert_frame_equal(res, expected)
+            self.assertEqual(progress[-1], (4, 4))
+
+        progress = []
+        with patch(significance, '_MAX_BATCH_GROUPS', 3):
+            res = t_test(self.X, self.y, callback=lambda *args: progress.append(args))
+            pd.testing.assert_frame_equal(res, expected)
+            self.assertEqual(progress[-1], (4, 4))
+
+            token = CancellationToken()
+            with self.assertRaises(Cancelled):
+                t_test(self.X, self.y, callback=lambda *_: token.cancel(),
+                       cancel_token=token)
+
+    def test_small_groups_permutation(self):
+        X = np.r_[self.X, np.repeat([10, 11], 8)]
+        y = np.r_[self.y, np.random.RandomState(1).normal(1, size=16)]
+        # Groups smaller than 20 are permuted by default
+        res = mannwhitneyu_test(X, y)
+        self.assertEqual(res['method'][(3,)], 'approximate')
+        self.assertEqual(res['method'][(10,)], 'permutation')
+        for g in (10, 11):
+            expected = mannwhitneyu(y[X == g], y, method='exact')[1]
+            self.assertAlmostEqual(res[PVALUE_LABEL][(g,)], expected, delta=.02)
+        res = fligner_killeen_test(X, y)
+        self.assertEqual(res['method'][(11,)], 'permutation')
+
+    def test_small_group_two_tailed_pvalue(self):
+        # Permutation p-values are two-tailed and not reversed at the high end
+        X = np.r_[self.X, np.repeat(10, 8)]
+        y = np.r_[self.y, np.random.RandomState(3).normal(size=8)]
+        expected = mannwhitneyu(y[X == 10], y, method='exact')[1]
+        self.assertGreater(expected, .5)
+        res = mannwhitneyu_test(X, y, min_count=1)
+        self.assertEqual(res['method'][(10,)], 'permutation')
+        self.assertAlmostEqual(res[PVALUE_LABEL][(10,)], expected, delta=.02)
+
+    def test_small_groups_nulls_computed_once(self):
+        X = np.r_[self.X, np.repeat([10, 11, 12], [8, 8, 3])]
+        y = np.r_[self.y, np.random.RandomState(1).normal(1, size=19)]
+        sizes = []
+
+        def sample_indices(rng, N, n, n_samples, _sample=significance._sample_indices):
+            sizes.append(n)
+            return _sample(rng, N, n, n_samples)
+
+        expected = mannwhitneyu_test(X, y, min_count=5)
+        with patch(significance, '_sample_indices', sample_indices), \
+                patch(significance, '_MAX_BATCH_ROWS', 300):
+            res = mannwhitneyu_test(X, y, min_count=5)
+        pd.testing.assert_frame_equal(res, expected)
+        # One null for both groups of size 8, none for the group of size 3
+        self.assertEqual(sizes, [8])
+
+    def test_fligner_killeen_test(self):
+        self.assert_pvals_equal(
+            fligner_killeen_test(self.X, self.y),
+            [fligner(self.y[g], self.y)[1] for g in self.groups], two_sided=True,
+            rtol=1e-6)
+
+    def test_fligner_killeen_test_ties(self):
+        for y in (self.y.round(1),
+                  np.random.RandomState(1).poisson(2, self.y.size).astype(float)):
+            self.assert_pvals_equal(
+                fligner_killeen_test(self.X, y),
+                [fligner(y[g], y)[1] for g in self.groups], two_sided=True, rtol=1e-6)
+
+    def test_fligner_killeen_test_tied_deviations(self):
+        # distinct values, but deviations from the median tie in pairs
+        y = np.random.RandomState(1).permutation(self.y.size).astype(float)
+        expected = [fligner(y[g], y)[1] for g in self.groups]
+        self.assert_pvals_equal(fligner_killeen_test(self.X, y), expected,
+                                two_sided=True, rtol=1e-6)
+        with patch(significance, '_MAX_CHUNK_ELEMENTS', 1):
+            self.assert_pvals_equal(fligner_killeen_test(self.X, y), expected,
+                                two_sided=True, rtol=1e-6)
+
+            class Token:
+                checks = 0
+
+                @property
+                def cancelled(self):
+                    self.checks += 1
+                    return self.checks > 2
+
+            token = Token()
+            with self.assertRaises(Cancelled):
+                fligner_killeen_test(self.X, y, cancel_token=token)
+            self.assertEqual(token.checks, 3)
+
+    def test_hyper_test(self):
+        y = self.y > 1
+        res = hyper_test(self.X, y)
+        self.assert_pvals_equal(
+            res, [hypergeom(M=y.size, n=y.sum(), N=g.sum(), loc=1).sf(y[g].sum())
+                  for g in self.groups])
+        self.assertEqual(res['count | class'][(3,)], y[self.X == 3].sum())
+
+    def test_chi2_test(self):
+        y = np.digitize(self.y, [-.5, .5]).astype(str)
+        res = chi2_test(self.X, y)
+        self.assertLess(res[PVALUE_LABEL][(3,)], .01)
+        self.assertTrue((res['count'] == [g.sum() for g in self.groups]).all())
+
+    def test_multi_target_test(self):
+        X = np.where(np.arange(self.X.size) % 50, self.X, -1).astype(float)
+        X[X == -1] = np.nan
+        Y = pd.DataFrame({'u': self.y, 'v': -self.y, 'w': self.y[::-1]})
+        Y.iloc[::7, 1] = np.nan
+        for test, func in (('t', t_test),
+                           ('fligner', fligner_killeen_test),
+                           ('mannwhitneyu', mannwhitneyu_test)):
+            res = multi_target_test(X, Y, test=test)
+            self.assertEqual(list(res['target'].unique()), ['u', 'v', 'w'])
+            for target in Y:
+                pd.testing.assert_frame_equal(
+                    res[res['target'] == target].drop(columns='target'),
+                    func(X, Y[target]), check_dtype=False)
+
+        Y = (Y > 1).where(Y.notnull())
+        res = multi_target_test(X, Y, test='hyper')
+        for target in Y:
+            known = Y[target].notnull().values
+            pd.testing.assert_frame_equal(
+                res[res['target'] == target].drop(columns='target'),
+                hyper_test(X[known], Y[target][known].astype(bool)), check_dtype=False)
+
+    def test_multi_target_test_arguments(self):
+        Y = pd.DataFrame({'u': self.y, 'v': -self.y})
+        progress = []
+        multi_target_test(self.X, Y, callback=lambda *args: progress.append(args))
+        self.assertEqual(progress[-1], (1, 1))
+        token = CancellationToken()
+        token.cancel()
+        with self.assertRaises(Cancelled):
+            multi_target_test(self.X, Y, cancel_token=token)
+
+        Y = pd.DataFrame({'u': np.digitize(self.y, [-.5, .5]).astype(str)})
+        res = multi_target_test(self.X, Y, test='chi2', ddof=1)
+        pd.testing.assert_frame_equal(res.drop(columns='target'),
+                                      chi2_test(self.X, Y['u'], ddof=1), check_dtype=False)
+
+
+class TestStreamingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rs = np.random.RandomState(0)
+        n = 5000
+        cls.X = pd.DataFrame({'a': rs.choice(list('pqr'), n),
+                              'b': rs.randint(0, 6, n)})
+        cls.X.iloc[::50, 0] = None
+        cls.y = pd.Series(rs.normal(size=n) + (cls.X.b == 2))
+        cls.y[::13] = np.nan
+
+    def chunks(self, y, size=700):
+        for i in range(0, len(y), size):
+            yield self.X.iloc[i:i + size], y.iloc[i:i + size]
+
+    def test_streaming_test(self):
+        classes = pd.Series(np.digitize(self.y, [-.5, .5]).astype(str))
+        classes[self.y.isnull()] = None
+        for test, func, y in (('t', t_test, self.y),
+                              ('gumbel_max', gumbel_max_test, self.y),
+                              ('hyper', hyper_test, self.y > 1),
+                              ('chi2', chi2_test, classes)):
+            pd.testing.assert_frame_equal(streaming_test(self.chunks(y), test=test),
+                                          func(self.X, y), check_dtype=False)
+
+    def test_streaming_integer_target(self):
+        y = pd.Series(np.random.RandomState(1).randint(0, 10**9, len(self.y)))
+        pd.testing.assert_frame_equal(streaming_test(self.chunks(y)),
+                                      t_test(self.X, y), check_dtype=False)
+        # integers are numeric, so no classes are counted
+        stats = GroupStatistics()
+        for X, chunk in self.chunks(y):
+            stats.update(X, chunk)
+        self.assertEqual(stats.table.shape, (stats.n_groups, 0))
+
+    def test_merge(self):
+        stats1, stats2 = GroupStatistics(), GroupStatistics()
+        for i, (X, y) in enumerate(self.chunks(self.y)):
+            (stats1 if i % 2 else stats2).update(X, y)
+        pd.testing.assert_frame_equal(stats1.merge(stats2).test('t'),
+                                      t_test(self.X, self.y), check_dtype=False)
+
+
+class TestCorrections(unittest.TestCase):
+    def test_corrections(self):
+        pvals = pd.Series([.01, .04, .03, .5])
+        np.testing.assert_allclose(correction_benjamini_hochberg(pvals),
+                                   [.04, .16 / 3, .16 / 3, .5])
+        np.testing.assert_allclose(correction_benjamini_hochberg(pvals, 8),
+                                   [.08, .32 / 3, .32 / 3, 1])
+        np.testing.assert_allclose(correction_bonferroni(pvals, 10), [.1, .4, .3, 1])
+
+    def test_n_tests(self):
+        X = np.r_[np.repeat(np.arange(5), 20), [5, 6]]
+        y = np.arange(X.size) % 7
+        self.assertEqual(t_test(X, y).attrs['n_tests'], 7)
+
+
+class TestGroupKeys(unittest.TestCase):
+    def test_group_keys(self):
+        rs = np.random.RandomState(0)
+        n = 1000
+        X = pd.DataFrame({'a': rs.choice(list('xyz'), n),
+                          'b': rs.randint(0, 5, n) * .5})
+        # Cardinalities whose product overflows int64
+        for i in range(4):
+            X['c%d' % i] = rs.randint(0, 2**20, n)
+        for columns in (['a', 'b'], list(X.columns)):
+            keys = _GroupKeys(X[columns])
+            tuples = pd.Series(list(zip(*X[columns].values.T))).astype('category')
+            np.testing.assert_equal(keys.codes, tuples.cat.codes.values)
+            self.assertEqual(keys.labels(), list(tuples.cat.categories))
+            self.assertEqual(keys.labels([2, 0]), list(tuples.cat.categories[[2, 0]]))
+
+
+class TestSubgroupSearch(unittest.TestCase):
+    def test_subgroup_search(self):
+        rs = np.random.RandomState(0)
+        n = 2000
+        X = pd.DataFrame({'a': rs.randint(0, 3, n),
+                          'b': rs.choice(list('xyz'), n),
+                          'c': rs.randint(0, 2, n)})
+        y = rs.normal(size=n) + ((X.a == 1) & (X.b == 'y'))
+        res = subgroup_search(X, y, max_depth=2, min_count=100)
+        self.assertTrue((res['count'] >= 100).all())
+        self.assertEqual(res[PVALUE_LABEL].idxmin()[:2], (1, 'y'))
+
+        for columns in (['a'], ['b', 'c'], ['a', 'c']):
+            expected = t_test(X[columns], y, min_count=100)
+            for label, pval in expected[PVALUE_LABEL].items():
+                label = tuple(dict(zip(columns, label)).get(col) for col in X.columns)
+                self.assertAlmostEqual(res[PVALUE_LABEL][label], pval)
+        # No three-column subgroups
+        self.assertFalse(any(None not in label for label in res.index))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,17 @@
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import numpy as np
+
+from Orange.base import Model
 from Orange.data import Table
-from Orange.modelling import KNNLearner, TreeLearner
+from Orange.classification import LogisticRegressionLearner, NaiveBayesLearner
+from Orange.modelling import ConstantLearner, KNNLearner, TreeLearner
 from Orange.evaluation import CA, CrossValidation, MSE
 
-from orangecontrib.prototypes.stack import StackedFitter
+from orangecontrib.prototypes import stack
+from orangecontrib.prototypes.stack import StackedFitter, BaseFitCache
 
 
 class TestStackedFitter(unittest.TestCase):
@@ -25,3 +33,134 @@ class TestStackedFitter(unittest.TestCase):
         mse = MSE(results)
         self.assertLess(mse[0], mse[1])
         self.assertLess(mse[0], mse[2])
+
+    def test_n_jobs(self):
+        data = self.iris[::2]
+        probs = [StackedFitter([TreeLearner(), KNNLearner()], n_jobs=n_jobs)(data)
+                 (self.iris[1::2], Model.Probs) for n_jobs in (1, 2)]
+        np.testing.assert_equal(*probs)
+
+    def test_n_jobs_predict(self):
+        executors = []
+
+        class Executor(ThreadPoolExecutor):
+            def __init__(self, max_workers):
+                executors.append(max_workers)
+                super().__init__(max_workers)
+
+        data = self.iris[::2]
+        expected = StackedFitter([TreeLearner(), KNNLearner()])(data)(self.iris, Model.Probs)
+        model = StackedFitter([TreeLearner(), KNNLearner()], n_jobs=2)(data)
+        self.assertEqual(model.n_jobs, 2)
+        with patch.object(stack, 'ThreadPoolExecutor', Executor):
+            np.testing.assert_almost_equal(model(self.iris, Model.Probs), expected)
+        self.assertEqual(executors, [2])
+
+    def test_missing_class(self):
+        for data in (self.iris[::2], self.housing[::4]):
+            data = data.copy()
+            with data.unlocked(data.Y):
+                data.Y[:5] = np.nan
+            model = StackedFitter([TreeLearner(), KNNLearner()])(data)
+            self.assertFalse(np.isnan(model(data)).any())
+
+    def test_cv_bagging(self):
+        sf = StackedFitter([TreeLearner(), KNNLearner()], k=3, refit=False)
+        model = sf(self.iris[::2])
+        self.assertEqual([len(models) for models in model.models], [3, 3])
+        self.assertGreater(CA(CrossValidation(self.iris, [sf], k=3)), 0.9)
+
+        sf = StackedFitter([TreeLearner(), KNNLearner()], refit=False)
+        results = CrossValidation(self.housing[:50], [sf, TreeLearner()], k=3)
+        mse = MSE(results)
+        self.assertLess(mse[0], mse[1])
+
+    def test_blending(self):
+        for refit in (True, False):
+            sf = StackedFitter([TreeLearner(), KNNLearner()], holdout=.3, refit=refit)
+            self.assertGreater(CA(CrossValidation(self.iris, [sf], k=3)), 0.9)
+        model = sf(self.housing)
+        self.assertEqual([len(models) for models in model.models], [1, 1])
+
+    def test_predict_in_batches(self):
+        for data, ret in ((self.iris, Model.Probs), (self.housing, Model.Value)):
+            model = StackedFitter([TreeLearner(), KNNLearner()])(data[::2])
+            expected = model(data, ret)
+            model.batch_size, model.n_jobs = 7, 2
+            np.testing.assert_almost_equal(model(data, ret), expected)
+
+    def test_cache(self):
+        fits = []
+
+        class CountingTree(TreeLearner):
+            def __call__(self, data, *args, **kwargs):
+                fits.append(len(data))
+                return super().__call__(data, *args, **kwargs)
+
+        cache = BaseFitCache()
+        learners = [CountingTree(), KNNLearner()]
+        data = self.iris[::2]
+        expected = StackedFitter(learners)(data)(self.iris, Model.Probs)
+        n_fits = len(fits)
+        self.assertEqual(n_fits, 5 + 1)
+        np.testing.assert_equal(
+            StackedFitter(learners, cache=cache)(data)(self.iris, Model.Probs),
+            expected)
+        self.assertEqual(len(fits), 2 * n_fits)
+
+        # Different aggregator and new learner: the cached tree isn't refit
+        learners.append(NaiveBayesLearner())
+        StackedFitter(learners, cache=cache,
+                      aggregate=LogisticRegressionLearner(C=.1))(data)
+        self.assertEqual(len(fits), 2 * n_fits)
+        # Different data
+        StackedFitter(learners, cache=cache)(self.iris[1::2])
+        self.assertEqual(len(fits), 3 * n_fits)
+
+    def test_prune(self):
+        learners = [TreeLearner(), ConstantLearner(), KNNLearner()]
+        model = StackedFitter(learners, prune=0.05)(self.iris)
+        self.assertEqual(model.pruned, [1])
+        self.assertEqual(len(model.models), 2)
+        self.assertGreater(model.time_saved, 0)
+        self.assertEqual(len(model.aggregate.domain.attributes), 6)
+        self.assertGreater(np.mean(model(self.iris) == self.iris.Y), 0.9)
+
+        # Aggregator without coefficients
+        model = StackedFitter(learners, prune=0.05,
+                              aggregate=NaiveBayesLearner())(self.iris)
+        self.assertEqual(model.pruned, [1])
+
+        model = StackedFitter(learners)(self.iris)
+        self.assertEqual(model.pruned, [])
+
+    def test_levels(self):
+        sf = StackedFitter([TreeLearner(), KNNLearner()], k=3,
+                           levels=[[TreeLearner(), LogisticRegressionLearner()]])
+        model = sf(self.iris[::2])
+        self.assertEqual(len(model.aggregate.models), 2)
+        self.assertGreater(CA(CrossValidation(self.iris, [sf], k=3)), 0.9)
+
+    def test_meta_data(self):
+        data = self.iris[::2]
+        self.assertIsNone(StackedFitter([TreeLearner(), KNNLearner()])(data).meta_data)
+        model = StackedFitter([TreeLearner(), KNNLearner()], keep_meta_data=True)(data)
+        meta_data = model.meta_data
+        self.assertEqual(meta_data.X.shape, (len(data), 6))
+        np.testing.assert_equal(meta_data.Y, data.Y)
+        np.testing.assert_equal(meta_data.ids, data.ids)
+        np.testing.assert_almost_equal(meta_data.X[:, :3].sum(axis=1), 1)
+
+        # Out-of-fold predictions can be stacked on without refitting
+        model = StackedFitter([LogisticRegressionLearner()])(meta_data)
+        self.assertGreater(np.mean(model(meta_data) == data.Y), 0.9)
+
+        # Outputs of pruned models are not kept
+        learners = [TreeLearner(), ConstantLearner(), KNNLearner()]
+        model = StackedFitter(learners, prune=0.05, keep_meta_data=True)(self.iris)
+        self.assertEqual(model.pruned, [1])
+        self.assertEqual([var.name for var in model.meta_data.domain.attributes],
+                         [var.name for var in model.aggregate.domain.attributes])
+        np.testing.assert_equal(model.meta_data.X[:, :3],
+                                StackedFitter(learners[:1], keep_meta_data=True)(
+                                    self.iris).meta_data.X)
@@ -1,7 +1,10 @@
 import sys
-import copy
 import logging
+import multiprocessing
+import warnings
 import concurrent.futures
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor
+from contextlib import nullcontext
 from functools import partial
 import time
 from enum import IntEnum
@@ -16,7 +19,9 @@ from AnyQt.QtCore import (
 from AnyQt.QtGui import QPen, QColor, QBrush, QPainter, QFont
 import numpy as np
 from numpy.random import RandomState
+import scipy.sparse as sp
 import scipy.stats as st
+from sklearn.ensemble import ExtraTreesRegressor, RandomForestRegressor
 
 import Orange
 import Orange. evaluation
@@ -25,6 +30,7 @@ from Orange.widgets import gui, widget, settings
 from Orange.widgets.utils.itemmodels import TableModel
 from Orange.widgets.utils.sql import check_sql_input
 from Orange.base import Model
+from Orange.regression.linear import LinearModel
 from Orange.data import (
     DiscreteVariable, ContinuousVariable, StringVariable, Domain,
     Table)
@@ -33,6 +39,9 @@ from Orange.widgets.utils.concurrent import (
 )
 
 
+SAMPLING = ("random", "antithetic", "halton", "sobol")
+
+
 class SortBy(IntEnum):
     NO_SORTING, BY_NAME, ABSOLUTE, POSITIVE, NEGATIVE = 0, 1, 2, 3, 4
 
@@ -54,6 +63,296 @@ class Task:
         concurrent.futures.wait([self.future])
 
 
+def _numeric_branch(threshold, values):
+    branch = (values > threshold).astype(int)
+    branch[np.isnan(values)] = -1
+    return branch
+
+
+def _discrete_branch(values, mapping=None):
+    branch = np.full(len(values), -1)
+    known = ~np.isnan(values)
+    branch[known] = values[known] if mapping is None else mapping[values[known].astype(int)]
+    return branch
+
+
+def _orange_tree_nodes(model):
+    """
+    Flattens Orange's tree into a list of (attribute index, branch function, child indices,
+    prediction); leaves have attribute index -1, missing children have index -1
+    """
+    nodes = []
+    is_discrete = model.domain.class_var.is_discrete
+
+    def add(node):
+        index = len(nodes)
+        nodes.append(None)
+        value = np.argmax(node.value) if is_discrete else node.value[0]
+        if not node.children:
+            nodes[index] = (-1, None, (), value)
+            return index
+        if hasattr(node, "threshold"):
+            branch = partial(_numeric_branch, node.threshold)
+        else:
+            branch = partial(_discrete_branch, mapping=getattr(node, "mapping", None))
+        children = [-1 if child is None else add(child) for child in node.children]
+        nodes[index] = (node.attr_idx, branch, children, value)
+        return index
+
+    add(model.root)
+    return nodes
+
+
+def _skl_tree_nodes(tree, classes=None):
+    """Flattens scikit-learn's tree into the same form as `_orange_tree_nodes`"""
+    tree = tree.tree_
+    values = tree.value[:, 0]
+    values = values[:, 0] if classes is None else classes[np.argmax(values, axis=1)]
+    nodes = []
+    for index, value in enumerate(values):
+        if tree.children_left[index] == -1:
+            nodes.append((-1, None, (), value))
+        else:
+            nodes.append((tree.feature[index],
+                          partial(_numeric_branch, tree.threshold[index]),
+                          [tree.children_left[index], tree.children_right[index]],
+                          value))
+    return nodes
+
+
+# Upper bounds on outcomes of all trees x reference rows that are walked when preparing exact
+# contributions (beyond it, reference rows are subsampled), on the size of tables of outcomes
+# (beyond it, models are explained by sampling) and on the size of arrays of outcomes x
+# instances that are explained at once
+_MAX_TREE_WORK = 2**27
+_MAX_TREE_TABLES = 2**25
+_MAX_CHUNK_ELEMENTS = 2**20
+
+
+def _popcount(codes):
+    """Number of set bits of each of int64 codes"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(codes).astype(int)
+    table = np.array([bin(i).count("1") for i in range(256)])
+    return table[codes.view(np.uint8)].reshape(codes.shape + (8,)).sum(axis=-1)
+
+
+def _walk_paths(nodes, X, sources, visit):
+    """
+    Enumerates the outcomes of the tree, leaves and nodes at which a missing value or branch
+    stops, and calls `visit` with their predicted values, the attributes on their paths, codes
+    for rows of X (in the model's domain), or None if X is None, and the paths' edges. Bit i of
+    a row's code tells whether the row's value of the path's i-th attribute agrees with the
+    path. Edges are tuples of a node's index, the branch taken and the bit of its attribute.
+    Only the codes of the current path are kept.
+    """
+    def walk(index, atrs, codes, edges):
+        col, branch, children, value = nodes[index]
+        if col < 0:
+            visit(value, atrs, codes, edges)
+            return
+        atr = sources[col]
+        if atr not in atrs:
+            if codes is not None:
+                codes = codes | (1 << len(atrs))
+            atrs = atrs + (atr, )
+        bit = atrs.index(atr)
+        row_branch = None if X is None else branch(X[:, col])
+        for child_branch in range(-1, len(children)):
+            child_codes = None if X is None else \
+                np.where(row_branch == child_branch, codes, codes & ~(1 << bit))
+            child_edges = edges + ((index, child_branch, bit), )
+            child = children[child_branch] if child_branch >= 0 else -1
+            if child < 0:
+                visit(value, atrs, child_codes, child_edges)
+            else:
+                walk(child, atrs, child_codes, child_edges)
+
+    walk(0, (), None if X is None else np.zeros(len(X), dtype=np.int64), ())
+
+
+def _path_attributes(trees, sources):
+    """Attributes on paths to outcomes of all trees, in the order of `_walk_paths`"""
+    paths = []
+    for nodes in trees:
+        _walk_paths(nodes, None, sources, lambda _, atrs, __, ___: paths.append(atrs))
+    return paths
+
+
+class _TreeReference:
+    """
+    Agreement of reference rows with paths of trees, from which exact contributions are
+    computed for any instance without going through the rows again.
+
+    A path's outcome is reached if each attribute on the path is taken from a source (the
+    instance or a row) that agrees with the path, which happens with probability 1, 1/2 or 0
+    if both, one or neither source agrees. Replacing the value of an attribute on which only
+    one source agrees changes the probability by 2^(1 - m), where m is the number of such
+    attributes; the contribution is the outcome's score times this, positive if the instance
+    agrees and negative otherwise.
+
+    With the set U of attributes on which the instance disagrees, m is |U| plus the number
+    of attributes on which the row disagrees, and the row must agree on U. For each outcome,
+    a table thus holds, for every subset U of the path's attributes, the sum of 2^-(number of
+    disagreements) over rows that agree on U, and contributions are looked up in it for U
+    and U with one more attribute. The tables are kept for each of `n_groups` groups of rows.
+    """
+    def __init__(self, trees, X, sources, groups, n_groups, no_atr):
+        self.trees = trees
+        self.sources = sources
+        self.n_rows = len(X)
+        self.n_groups = n_groups
+        self.no_atr = no_atr
+        paths, edges = [], []
+        for tree, nodes in enumerate(trees):
+            _walk_paths(nodes, None, sources, lambda _, atrs, __, path_edges, tree=tree: (
+                paths.append(atrs),
+                edges.append([(tree, index, branch, bit) for index, branch, bit in path_edges])))
+        self._init_edges(trees, edges)
+        self.n_atrs = np.array([len(atrs) for atrs in paths], dtype=np.int64)
+        self.path_atrs = np.zeros((len(paths), max(self.n_atrs, default=0)), dtype=int)
+        for i, atrs in enumerate(paths):
+            self.path_atrs[i, :len(atrs)] = atrs
+        self.offsets = np.r_[0, np.cumsum(1 << self.n_atrs)[:-1]]
+
+        # rows are counted by their codes directly into the tables
+        self.tables = np.empty((int(np.sum(1 << self.n_atrs)), n_groups))
+        values = []
+
+        def count(value, atrs, codes, _):
+            offset = self.offsets[len(values)]
+            self.tables[offset:offset + (1 << len(atrs))] = np.bincount(
+                codes * n_groups + groups, minlength=n_groups << len(atrs)
+            ).reshape(-1, n_groups)
+            values.append(value)
+
+        for nodes in trees:
+            _walk_paths(nodes, X, sources, count)
+        self.values = np.array(values)
+
+        # each row of a group counts for its share of the group, and each tree equally
+        group_rows = np.bincount(groups, minlength=n_groups)
+        for k in np.unique(self.n_atrs):
+            outcomes = np.flatnonzero(self.n_atrs == k)
+            subsets = np.arange(1 << k)
+            index = self.offsets[outcomes, None] + subsets
+            tables = self.tables[index]
+            tables *= (0.5 ** (k - _popcount(subsets)))[:, None] / group_rows / len(trees)
+            # sums over supersets, bit by bit
+            for bit in range(k):
+                split = tables.reshape(len(outcomes), -1, 2, (1 << bit) * n_groups)
+                split[:, :, 0] += split[:, :, 1]
+            self.tables[index] = tables
+
+    def _init_edges(self, trees, edges):
+        """Flattens the edges of paths to outcomes, with the nodes numbered across trees"""
+        first_node = np.cumsum([0] + [len(nodes) for nodes in trees])
+        flat = np.array([(first_node[tree] + index, branch, bit)
+                         for path_edges in edges for tree, index, branch, bit in path_edges],
+                        dtype=np.int64).reshape(-1, 3)
+        self.edge_node, self.edge_branch, self.edge_bit = flat.T
+        n_edges = np.array([len(path_edges) for path_edges in edges])
+        self.with_edges = np.flatnonzero(n_edges)
+        self.edge_starts = (np.cumsum(n_edges) - n_edges)[self.with_edges]
+        # the nodes' branch functions; thresholds of numeric nodes are compared at once
+        internal = [(first_node[tree] + index, col, branch)
+                    for tree, nodes in enumerate(trees)
+                    for index, (col, branch, _, _) in enumerate(nodes) if col >= 0]
+        numeric = [(node, col, branch.args[0]) for node, col, branch in internal
+                   if branch.func is _numeric_branch]
+        self.numeric_nodes, self.numeric_cols, self.thresholds = \
+            np.array(numeric, dtype=float).reshape(-1, 3).T
+        self.numeric_nodes = self.numeric_nodes.astype(int)
+        self.numeric_cols = self.numeric_cols.astype(int)
+        self.other_nodes = [(node, col, branch) for node, col, branch in internal
+                            if branch.func is not _numeric_branch]
+        self.n_nodes = first_node[-1]
+
+    def _instance_codes(self, X):
+        """Codes of rows of X for all outcomes (as from `_walk_paths`), outcomes x rows"""
+        branches = np.zeros((self.n_nodes, len(X)), dtype=int)
+        values = X[:, self.numeric_cols].T
+        numeric = (values > self.thresholds[:, None]).astype(int)
+        numeric[np.isnan(values)] = -1
+        branches[self.numeric_nodes] = numeric
+        for node, col, branch in self.other_nodes:
+            branches[node] = branch(X[:, col])
+        mismatch = (branches[self.edge_node] != self.edge_branch[:, None]).astype(np.int64)
+        disagree = np.zeros((len(self.n_atrs), len(X)), dtype=np.int64)
+        if len(self.with_edges):
+            disagree[self.with_edges] = np.bitwise_or.reduceat(
+                mismatch << self.edge_bit[:, None], self.edge_starts, axis=0)
+        return ((1 << self.n_atrs)[:, None] - 1) & ~disagree
+
+    def contributions(self, X, class_values, is_discrete):
+        """Contributions of attributes of rows of X (in the model's domain) averaged over the
+        rows of each group; an array instances x groups x attributes"""
+        n_outcomes, max_atrs = self.path_atrs.shape
+        class_values = np.asarray(class_values)
+        # outcomes with a bit, and matrices that sum them by attributes
+        on_path = [np.flatnonzero(self.n_atrs > bit) for bit in range(max_atrs)]
+        to_atrs = [sp.csr_matrix((np.ones(len(outcomes)),
+                                  (self.path_atrs[outcomes, bit], np.arange(len(outcomes)))),
+                                 shape=(self.no_atr, len(outcomes)))
+                   for bit, outcomes in enumerate(on_path)]
+        result = np.empty((len(X), self.n_groups, self.no_atr))
+        # instances are passed through the trees in larger chunks than they are explained in
+        walk_size = max(1, 8 * _MAX_CHUNK_ELEMENTS // max(len(self.edge_node), 1))
+        chunk_size = max(1, _MAX_CHUNK_ELEMENTS // (n_outcomes * self.n_groups))
+        for walk_start in range(0, len(X), walk_size):
+            walked = self._instance_codes(X[walk_start:walk_start + walk_size])
+            for start in range(0, walked.shape[1], chunk_size):
+                inst_codes = walked[:, start:start + chunk_size]
+                chunk = slice(walk_start + start, walk_start + start + inst_codes.shape[1])
+                # attributes on which the instance disagrees
+                disagree = ((1 << self.n_atrs)[:, None] - 1) & ~inst_codes
+                values = self.values[:, None]
+                scores = values == class_values[None, chunk] if is_discrete else values
+                scale = (scores * 0.5 ** (_popcount(disagree) - 1))[:, :, None]
+                agree_on = self.tables[self.offsets[:, None] + disagree]
+                sums = np.zeros((self.no_atr, inst_codes.shape[1] * self.n_groups))
+                for bit, (outcomes, bit_to_atrs) in enumerate(zip(on_path, to_atrs)):
+                    bit_disagree = disagree[outcomes]
+                    bit_agree_on = agree_on[outcomes]
+                    # rows that also agree on the attribute, if the instance agrees on it
+                    also = self.tables[self.offsets[outcomes, None] + (bit_disagree | 1 << bit)]
+                    contribution = np.where(((bit_disagree >> bit) & 1)[:, :, None] == 1,
+                                            -bit_agree_on, bit_agree_on - also)
+                    sums += bit_to_atrs @ (scale[outcomes] * contribution).reshape(
+                        len(outcomes), -1)
+                result[chunk] = sums.reshape(self.no_atr, -1, self.n_groups).transpose(1, 2, 0)
+        return result
+
+
+# Explainer of the pool's model and data, set in each worker process of the parallel mode
+_worker_explainer = None
+
+
+def _init_worker(data, model):
+    global _worker_explainer
+    _worker_explainer = ExplainPredictions(data, model)
+
+
+def _sample_in_worker(settings, inst_x, class_values, atrs, n_steps, seed):
+    """
+    Samples attributes `atrs` of instances (rows of `inst_x`) for `n_steps` steps with the
+    explainer's `settings` (batch size, sampling and stratification) and returns their partial
+    statistics: attributes, sums of differences, M2 of batch means and the number of batches
+    """
+    e = _worker_explainer
+    e.batch_size, e.sampling, e.stratified = settings
+    draws = e.draws(RandomState(seed))
+    X, inst = e.prediction_buffer(2 * e.batch_size * len(inst_x))
+    total = mu = M2 = 0.
+    for n in range(1, n_steps + 1):
+        diff = e.sample_step(inst_x, class_values, atrs, draws, X, inst)
+        total = total + diff
+        d = diff / e.batch_size - mu
+        mu = mu + d / n
+        M2 = M2 + d * (diff / e.batch_size - mu)
+    return atrs, total, M2, n_steps
+
+
 class ExplainPredictions:
     """
     Class used to explain individual predictions by determining the importance of attribute values.
@@ -77,6 +376,22 @@ class ExplainPredictions:
         minimum number of iterations per attiribute
     seed : int
         seed for the numpy.random generator, default is 42
+    exact : bool
+        compute contributions of linear regression and tree models exactly instead of sampling
+    reference_rows : int or None
+        if given, contributions of trees are averaged over a random subsample of at most this
+        many rows of the data instead of all rows; they are then estimates with errors. By
+        default, all rows are used unless the trees are too large for that.
+    sampling : str
+        sampling of coalitions: "random", "antithetic" (each coalition is paired with its
+        complement) or low-discrepancy "halton" or "sobol" sequences
+    stratified : bool
+        draw background rows in random order without replacement, so that each row is used
+        equally often, instead of independently
+    n_jobs : int
+        number of worker processes that sample attributes in parallel; each task samples
+        `steps_per_task` batches. The processes receive the model and the data once and are
+        kept until `close` is called.
 
     Returns:
     -------
@@ -86,8 +401,10 @@ class ExplainPredictions:
         table containing atributes and corresponding contributions
 
     """
+    steps_per_task = 4
 
-    def __init__(self, data, model, p_val=0.05, error=0.05, batch_size=500, max_iter=10000000, min_iter=1000, seed=42):
+    def __init__(self, data, model, p_val=0.05, error=0.05, batch_size=500, max_iter=10000000, min_iter=1000, seed=42,
+                 exact=True, reference_rows=None, sampling="random", stratified=False, n_jobs=1):
         self.model = model
         self.data = data
         self.p_val = p_val
@@ -97,6 +414,15 @@ class ExplainPredictions:
         self.min_iter = min_iter
         self.atr_names = [var.name for var in data.domain.attributes]
         self.seed = seed
+        self.exact = exact
+        self.reference_rows = reference_rows
+        self.sampling = sampling
+        self.stratified = stratified
+        self.n_jobs = n_jobs
+        self._executor = None
+        self._executor_jobs = None
+        self._reference = None
+        self._reference_key = None
         """variables, saved for possible restart"""
         self.saved = False
         self.steps = None
@@ -106,21 +432,196 @@ class ExplainPredictions:
         self.var = None
         self.iterations_reached = None
 
-    def tile_instance(self, instance):
-        tiled_x = np.tile(instance._x, (self.batch_size, 1))
-        tiled_metas = np.tile(instance._metas, (self.batch_size, 1))
-        tiled_y = np.tile(instance._y, (self.batch_size, 1))
-        return Table.from_numpy(instance.domain, tiled_x, tiled_y, tiled_metas)
+    def prediction_buffer(self, n_rows):
+        """
+        Preallocates rows to be predicted with a single model call. Returns the array to be filled
+        in place and the model's input: the array itself if the model needs no domain conversion,
+        otherwise a table that shares it; the array is then filled with the table unlocked.
+        """
+        X = np.empty((n_rows, self.data.X.shape[1]))
+        if self.model.domain.attributes == self.data.domain.attributes:
+            return X, X
+        domain = Domain(self.data.domain.attributes, self.data.domain.class_vars)
+        inst = Table.from_numpy(domain, X, np.full((n_rows, len(domain.class_vars)), np.nan))
+        with inst.unlocked_reference():
+            inst.X = X
+        return X, inst
+
+    def exact_contributions(self, X, class_values):
+        """
+        Computes contributions for rows of X if the model is a linear regression or a tree
+        (or a regression forest); returns None for other models, which are explained by
+        sampling. The contributions are the quantities that sampling estimates.
+
+        Linear contributions are exact. Contributions of trees are averaged over all rows of
+        the data, so they are exact as well, unless `reference_rows` is set or the trees have
+        too many outcomes for the number of rows: the rows are then subsampled and errors are
+        estimated from the contributions for groups of rows. Trees whose paths are too long
+        or too varied are explained by sampling.
+
+        Returns:
+        -------
+        contributions: np.ndarray
+        errors: np.ndarray
+        """
+        if not self.exact:
+            return None
+        model = self.model
+        data_rows, no_atr = self.data.X.shape
+        sources = self._source_attributes()
+        if sources is None:
+            return None
+        if isinstance(model, LinearModel):
+            return self._linear_contributions(X, sources), np.zeros((len(X), no_atr))
+
+        skl_model = getattr(model, "skl_model", None)
+        if hasattr(model, "root"):
+            trees = [_orange_tree_nodes(model)]
+        elif hasattr(skl_model, "tree_"):
+            trees = [_skl_tree_nodes(skl_model, getattr(skl_model, "classes_", None))]
+        elif isinstance(skl_model, (RandomForestRegressor, ExtraTreesRegressor)):
+            trees = [_skl_tree_nodes(tree) for tree in skl_model.estimators_]
+        else:
+            return None
+
+        reference = self._tree_reference(trees, sources, skl_model is not None)
+        if reference is None:
+            return None
+        model_X = self._to_model_domain(X)
+        if skl_model is not None:
+            # scikit-learn compares values with thresholds in single precision
+            model_X = model_X.astype(np.float32)
+        per_group = reference.contributions(
+            model_X, class_values, self.data.domain.class_var.is_discrete)
+
+        n_ref = reference.n_rows
+        group_rows = np.bincount(np.arange(n_ref) % reference.n_groups)
+        contributions = np.tensordot(per_group, group_rows / n_ref, axes=([1], [0]))
+        errors = np.zeros((len(X), no_atr))
+        if n_ref < data_rows:
+            z = abs(st.norm.ppf(self.p_val/2))
+            errors = z * np.std(per_group, axis=1, ddof=1) / np.sqrt(reference.n_groups) \
+                * np.sqrt(1 - n_ref / data_rows)
+        return contributions, errors
+
+    def _tree_reference(self, trees, sources, single_precision):
+        """
+        Returns the agreement of reference rows with the trees' paths (see `_TreeReference`),
+        which is kept for further explanations of the same model and data, or None if it
+        would take too much memory.
+        Reference rows are all rows of the data unless `reference_rows` is set or the trees
+        are too large for that; rows are then subsampled and split into groups for
+        estimating errors.
+        """
+        # models and tables compare by identity
+        key = (self.model, self.data, self.reference_rows, self.seed)
+        if self._reference_key == key:
+            return self._reference
+        self._reference, self._reference_key = None, key
+        data_rows, no_atr = self.data.X.shape
+        paths = _path_attributes(trees, sources)
+        table_size = sum(1 << len(atrs) for atrs in paths)
+        if self.reference_rows is None:
+            n_ref = min(data_rows, max(_MAX_TREE_WORK // len(paths), 100))
+        else:
+            n_ref = min(data_rows, self.reference_rows)
+        if n_ref < data_rows:
+            n_groups = min(10, n_ref, _MAX_TREE_TABLES // table_size)
+            if n_groups < 2:
+                return None
+            reference = self.data[RandomState(self.seed).choice(data_rows, n_ref, replace=False)]
+        else:
+            if table_size > _MAX_TREE_TABLES:
+                return None
+            n_groups = 1
+            reference = self.data
+        X = Table.from_table(self.model.domain, reference).X
+        if single_precision:
+            X = X.astype(np.float32)
+        self._reference = _TreeReference(
+            trees, X, sources, np.arange(n_ref) % n_groups, n_groups, no_atr)
+        return self._reference
+
+    def _source_attributes(self):
+        """
+        Maps the model's attributes to indices of the data's attributes they are computed from,
+        or returns None if some can't be traced
+        """
+        attrs = self.data.domain.attributes
+        sources = []
+        for var in self.model.domain.attributes:
+            while var not in attrs:
+                var = getattr(var.compute_value, "variable", None)
+                if var is None:
+                    return None
+            sources.append(attrs.index(var))
+        return sources
+
+    def _to_model_domain(self, X):
+        domain = Domain(self.data.domain.attributes, self.data.domain.class_vars)
+        instances = Table.from_numpy(domain, X, np.full((len(X), len(domain.class_vars)), np.nan))
+        return Table.from_table(self.model.domain, instances).X
+
+    def _linear_contributions(self, X, sources):
+        """
+        Contribution of an attribute is the sum of coefficients times deviations from the mean of
+        the model's attributes that are computed from it
+        """
+        model_X = self._to_model_domain(X)
+        means = np.mean(Table.from_table(self.model.domain, self.data).X, axis=0)
+        contributions = np.zeros((len(X), self.data.X.shape[1]))
+        np.add.at(contributions.T, sources,
+                  (np.ravel(self.model.coefficients) * (model_X - means)).T)
+        return contributions
+
+    def draws(self, prng):
+        """
+        Yields coalitions (masks of attributes replaced by background values) and indices of
+        background rows for consecutive sampling steps
+        """
+        data_rows, no_atr = self.data.X.shape
+        engine = None
+        if self.sampling in ("halton", "sobol"):
+            from scipy.stats import qmc
+            engine = (qmc.Halton if self.sampling == "halton" else qmc.Sobol)(
+                no_atr, seed=prng.randint(2**31))
+        order, pos = None, data_rows
+        while True:
+            if self.sampling == "antithetic":
+                half = prng.random_sample(((self.batch_size + 1) // 2, no_atr)) > 0.5
+                perm = np.vstack((half, ~half))[:self.batch_size]
+            elif engine is not None:
+                with warnings.catch_warnings():
+                    # Sobol's balance properties need batches of size 2^m
+                    warnings.simplefilter("ignore")
+                    perm = engine.random(self.batch_size) > 0.5
+            else:
+                perm = (prng.random_sample(self.batch_size * no_atr).reshape(
+                    self.batch_size, no_atr)) > 0.5
+
+            if self.stratified:
+                rows = np.empty(self.batch_size, dtype=int)
+                filled = 0
+                while filled < self.batch_size:
+                    if pos == data_rows:
+                        order, pos = prng.permutation(data_rows), 0
+                    take = min(self.batch_size - filled, data_rows - pos)
+                    rows[filled:filled + take] = order[pos:pos + take]
+                    filled += take
+                    pos += take
+            else:
+                rows = prng.randint(0, data_rows, size=self.batch_size)
+            yield perm, rows
 
-    def init_arrays(self, no_atr):
+    def init_arrays(self, no_atr, n_inst=1):
         if not self.saved:
             self.saved = True
-            self.steps = np.zeros((1, no_atr), dtype=float)
-            self.mu = np.zeros((1, no_atr), dtype=float)
-            self.M2 = np.zeros((1, no_atr), dtype=float)
-            self.expl = np.zeros((1, no_atr), dtype=float)
-            self.var = np.ones((1, no_atr), dtype=float)
-            self.iterations_reached = np.zeros((1, no_atr))
+            self.steps = np.zeros((n_inst, no_atr), dtype=float)
+            self.mu = np.zeros((n_inst, no_atr), dtype=float)
+            self.M2 = np.zeros((n_inst, no_atr), dtype=float)
+            self.expl = np.zeros((n_inst, no_atr), dtype=float)
+            self.var = np.ones((n_inst, no_atr), dtype=float)
+            self.iterations_reached = np.zeros((n_inst, no_atr))
         else:
             self.iterations_reached = np.copy(self.steps)
 
@@ -136,19 +637,18 @@ class ExplainPredictions:
         return np.asarray(attr_values)
 
     def anytime_explain(self, instance, callback=None, update_func=None, update_prediction=None):
-        data_rows, no_atr = self.data.X.shape
-        class_value = self.model(instance)[0]
+        no_atr = self.data.X.shape[1]
+        class_value = np.atleast_1d(self.model(instance))[0]
         prng = RandomState(self.seed)
 
         self.init_arrays(no_atr)
         attr_values = self.get_atr_column(instance)
 
-        batch_mx_size = self.batch_size * no_atr
+        draws = self.draws(prng)
         z_sq = abs(st.norm.ppf(self.p_val/2))**2
 
-        tiled_inst = self.tile_instance(instance)
-        inst1 = copy.deepcopy(tiled_inst)
-        inst2 = copy.deepcopy(tiled_inst)
+        inst_x = np.asarray(instance._x, dtype=float)
+        X, inst = self.prediction_buffer(2 * self.batch_size)
 
         worst_case = self.max_iter*no_atr
         time_point = time.time()
@@ -161,6 +661,12 @@ class ExplainPredictions:
         if update_prediction is not None:
             update_prediction(class_value)
 
+        exact = self.exact_contributions(inst_x[None, :], [class_value])
+        if exact is not None:
+            scores = np.column_stack((exact[0][0], exact[1][0]))
+            return class_value, Table.from_numpy(
+                domain, scores, metas=np.column_stack((self.atr_names, attr_values)))
+
         def create_res_table():
             nonzero = self.steps != 0
             expl_scaled = (self.expl[nonzero] /
@@ -173,6 +679,11 @@ class ExplainPredictions:
                                                       attr_values[nonzero[0]].reshape(-1, 1))))
             return table
 
+        if self.n_jobs > 1:
+            self._explain_in_processes(inst_x, class_value, prng, z_sq, callback,
+                                       lambda: update_func(create_res_table()))
+            return class_value, create_res_table()
+
         while not(all(self.iterations_reached[0, :] > self.max_iter)):
             prog = 1 - np.sum(self.max_iter -
                               self.iterations_reached)/worst_case
@@ -184,29 +695,9 @@ class ExplainPredictions:
             else:
                 a = np.argmin(self.iterations_reached[0, :])
 
-            perm = (prng.random_sample(batch_mx_size).reshape(
-                self.batch_size, no_atr)) > 0.5
-            rand_data = self.data.X[prng.randint(0,
-                                                 data_rows, size=self.batch_size), :]
-            inst1.X = np.copy(tiled_inst.X)
-            inst1.X[perm] = rand_data[perm]
-            inst2.X = np.copy(inst1.X)
-
-            inst1.X[:, a] = tiled_inst.X[:, a]
-            inst2.X[:, a] = rand_data[:, a]
-            f1 = self._get_predictions(inst1, class_value)
-            f2 = self._get_predictions(inst2, class_value)
-
-            diff = np.sum(f1 - f2)
-            self.expl[0, a] += diff
-
-            """update variance"""
-            self.steps[0, a] += self.batch_size
+            diff = self.sample_step(inst_x, class_value, a, draws, X, inst)
+            self.update_stats((0, a), diff)
             self.iterations_reached[0, a] += self.batch_size
-            d = diff - self.mu[0, a]
-            self.mu[0, a] += d / self.steps[0, a]
-            self.M2[0, a] += d * (diff - self.mu[0, a])
-            self.var[0, a] = self.M2[0, a] / (self.steps[0, a] - 1)
 
             if time.time() - time_point > 1:
                 update_table = True
@@ -216,13 +707,230 @@ class ExplainPredictions:
                 update_table = False
                 update_func(create_res_table())
 
-            # exclude from sampling if necessary
-            needed_iter = z_sq * self.var[0, a] / (self.error**2)
-            if (needed_iter <= self.steps[0, a]) and (self.steps[0, a] >= self.min_iter) or (self.steps[0, a] > self.max_iter):
-                self.iterations_reached[0, a] = self.max_iter + 1
+            self._exclude_if_done((0, a), z_sq)
 
         return class_value, create_res_table()
 
+    def sample_step(self, inst_x, class_value, a, draws, X, inst):
+        """
+        Predicts a batch of perturbed rows with and without the value of attribute `a` in the
+        buffer X from `prediction_buffer` and returns the sum of differences of predictions.
+
+        Several instances (rows of `inst_x` with arrays of class values and attributes) share
+        the coalitions and background rows and are predicted in a single call; the buffer then
+        holds two batches per instance and an array of sums is returned.
+        """
+        single = np.ndim(a) == 0
+        inst_x, a = np.atleast_2d(inst_x), np.atleast_1d(a)
+        perm, rows = next(draws)
+        rand_data = self.data.X[rows, :]
+
+        # both halves of a step, with and without the attribute's value, are predicted together
+        with inst.unlocked(inst.X) if isinstance(inst, Table) else nullcontext():
+            X = X.reshape(len(inst_x), 2, self.batch_size, inst_x.shape[1])
+            X[:] = inst_x[:, None, None, :]
+            np.copyto(X, rand_data, where=perm)
+            index = np.arange(len(inst_x))
+            X[index, 0, :, a] = inst_x[index, a][:, None]
+            X[index, 1, :, a] = rand_data[:, a].T
+        f = self._get_predictions(
+            inst, np.repeat(np.atleast_1d(class_value), 2 * self.batch_size))
+        f = f.reshape(len(inst_x), 2, self.batch_size)
+        diff = np.sum(f[:, 0], axis=1) - np.sum(f[:, 1], axis=1)
+        return diff[0] if single else diff
+
+    def _exclude_if_done(self, cell, z_sq):
+        """exclude from sampling if necessary"""
+        needed_iter = z_sq * self.var[cell] / (self.error**2)
+        steps = self.steps[cell]
+        done = (needed_iter <= steps) & (steps >= self.min_iter) | (steps > self.max_iter)
+        self.iterations_reached[cell] = np.where(
+            done, self.max_iter + 1, self.iterations_reached[cell])
+
+    def update_stats(self, cell, total, M2=0., n_batches=1):
+        """
+        Adds the sum of differences `total` over `n_batches` batches and the M2 of their batch
+        means to the statistics at `cell` (Welford's update for a single batch, Chan et al.
+        otherwise). The rows within a batch share the coalitions and are thus not independent,
+        so the variance is estimated from batch means and scaled to a single row; until two
+        batches are sampled, the initial variance is kept.
+        """
+        n = self.steps[cell] / self.batch_size
+        n_new = n + n_batches
+        delta = total / (n_batches * self.batch_size) - self.mu[cell]
+        self.mu[cell] += delta * n_batches / n_new
+        self.M2[cell] += M2 + delta**2 * n * n_batches / n_new
+        self.expl[cell] += total
+        self.steps[cell] += n_batches * self.batch_size
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.var[cell] = np.where(n_new > 1, self.batch_size * self.M2[cell] / (n_new - 1),
+                                      self.var[cell])
+
+    def _pool(self):
+        """Returns the pool of `n_jobs` worker processes, which is started on first use"""
+        if self._executor is not None and self._executor_jobs != self.n_jobs:
+            self.close()
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                self.n_jobs, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker, initargs=(self.data, self.model))
+            self._executor_jobs = self.n_jobs
+        return self._executor
+
+    def close(self):
+        """Shuts down the worker processes (if any)"""
+        if self._executor is not None:
+            # don't wait for the pending tasks
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _explain_in_processes(self, inst_x, class_value, prng, z_sq, callback, update):
+        """
+        Samples attributes in the pool of worker processes. Each task samples an attribute,
+        chosen with probability proportional to its variance, and its partial statistics are
+        merged into the attribute's. Two tasks per worker are kept queued.
+        """
+        worst_case = self.max_iter * len(self.atr_names)
+        time_point = time.time()
+        executor = self._pool()
+        settings = (self.batch_size, self.sampling, self.stratified)
+        pending = set()
+        try:
+            while True:
+                active = np.flatnonzero(self.iterations_reached[0, :] <= self.max_iter)
+                while len(active) and len(pending) < 2 * self.n_jobs:
+                    var = np.maximum(self.var[0, active], 1e-12)
+                    a = active[np.argmax(prng.multinomial(1, pvals=var / np.sum(var)))]
+                    pending.add(executor.submit(
+                        _sample_in_worker, settings, inst_x[None, :], [class_value], [a],
+                        self.steps_per_task, prng.randint(2**31)))
+                if not pending:
+                    break
+                done, pending = concurrent.futures.wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (a, ), (total, ), (M2, ), n_batches = future.result()
+                    self.update_stats((0, a), total, M2, n_batches)
+                    if self.iterations_reached[0, a] <= self.max_iter:
+                        self.iterations_reached[0, a] += n_batches * self.batch_size
+                        self._exclude_if_done((0, a), z_sq)
+
+                prog = 1 - np.sum(self.max_iter - np.minimum(self.iterations_reached, self.max_iter))/worst_case
+                if callback is not None and callback(int(prog*100)):
+                    break
+                if time.time() - time_point > 1:
+                    time_point = time.time()
+                    update()
+        finally:
+            # the pool is kept, but its queued tasks are no longer needed
+            for future in pending:
+                future.cancel()
+
+    def explain_batch(self, instances, callback=None, chunk_size=None):
+        """
+        Explains all instances of a table together. In each step, an attribute is chosen for
+        every instance whose contributions are not estimated yet; the perturbed rows of all these
+        instances share the coalitions and background rows and are predicted in a single call.
+        Instances are processed in chunks of `chunk_size` (by default, as many as fit into
+        100000 predicted rows).
+
+        Returns:
+        -------
+        class_values: np.ndarray
+            predicted class indices or values
+        table: Orange.data.Table
+            table of instances x attributes with contributions and, in metas, their errors
+            followed by the instances' metas; the table keeps the instances' ids
+        """
+        no_atr = self.data.X.shape[1]
+        prng = RandomState(self.seed)
+        draws = self.draws(prng)
+        if chunk_size is None:
+            chunk_size = max(1, 100000 // (2 * self.batch_size))
+
+        class_values = self.model(instances)
+        exact = self.exact_contributions(instances.X, class_values)
+        if exact is not None:
+            contributions, errors = exact
+        else:
+            contributions = np.full((len(instances), no_atr), np.nan)
+            errors = np.full((len(instances), no_atr), np.nan)
+            explained = 0
+            for start in range(0, len(instances), chunk_size):
+                chunk = slice(start, start + chunk_size)
+                rows = self._explain_chunk(instances.X[chunk], class_values[chunk], prng,
+                                           draws, contributions[chunk], errors[chunk],
+                                           callback, explained, len(instances))
+                if rows is None:
+                    break
+                explained += rows
+
+        domain = Domain([ContinuousVariable(name) for name in self.atr_names],
+                        metas=[ContinuousVariable(name + " (error)")
+                               for name in self.atr_names] + list(instances.domain.metas))
+        metas = np.hstack((errors.astype(instances.metas.dtype), instances.metas))
+        return class_values, Table.from_numpy(domain, contributions, metas=metas,
+                                              ids=instances.ids)
+
+    def _explain_chunk(self, inst_x, class_values, prng, draws, contributions, errors,
+                       callback, done_before, n_total):
+        """Estimates contributions and errors of a chunk of instances in place (best-so-far if
+        cancelled); returns the number of explained instances or None if cancelled"""
+        no_atr = self.data.X.shape[1]
+        z_sq = abs(st.norm.ppf(self.p_val/2))**2
+        X = inst = None
+
+        self.saved = False
+        self.init_arrays(no_atr, len(inst_x))
+
+        cancelled = False
+        while True:
+            done = self.iterations_reached > self.max_iter
+            if done.all():
+                break
+            prog = (done_before + done.sum() / no_atr) / n_total
+            if callback is not None and callback(int(prog*100)):
+                cancelled = True
+                break
+            active = np.flatnonzero(~done.all(axis=1))
+
+            # choose an attribute for each instance with probability proportional to its variance
+            weights = np.cumsum(np.where(done[active], 0, np.maximum(self.var[active], 1e-12)), axis=1)
+            u = prng.random_sample(len(active)) * weights[:, -1]
+            a = np.minimum((weights <= u[:, None]).sum(axis=1), no_atr - 1)
+
+            if self.n_jobs > 1:
+                # instances are split among workers, which sample several steps
+                settings = (self.batch_size, self.sampling, self.stratified)
+                futures = [
+                    (group, self._pool().submit(
+                        _sample_in_worker, settings, inst_x[group], class_values[group],
+                        atrs, self.steps_per_task, prng.randint(2**31)))
+                    for group, atrs in zip(np.array_split(active, self.n_jobs),
+                                           np.array_split(a, self.n_jobs))
+                    if len(group)]
+                results = [(group, ) + future.result() for group, future in futures]
+            else:
+                # the buffer is reallocated only when some instances are finished
+                if X is None or len(X) != 2 * self.batch_size * len(active):
+                    X, inst = self.prediction_buffer(2 * self.batch_size * len(active))
+                diff = self.sample_step(inst_x[active], class_values[active], a, draws, X, inst)
+                results = [(active, a, diff, 0., 1)]
+
+            for group, atrs, total, M2, n_batches in results:
+                cell = (group, atrs)
+                self.update_stats(cell, total, M2, n_batches)
+                self.iterations_reached[cell] += n_batches * self.batch_size
+                self._exclude_if_done(cell, z_sq)
+
+        # cells that were not sampled before cancellation are unknown
+        steps = self.steps
+        with np.errstate(invalid="ignore", divide="ignore"):
+            contributions[:] = np.where(steps > 0, self.expl / steps, np.nan)
+            errors[:] = np.where(steps > 0, np.sqrt(z_sq * self.var / steps), np.nan)
+        # the statistics of a chunk can't be resumed by `anytime_explain`
+        self.saved = False
+        return None if cancelled else len(inst_x)
+
     def _get_predictions(self, inst, class_value):
         if isinstance(self.data.domain.class_vars[0], ContinuousVariable):
             # regression
@@ -242,6 +950,9 @@ class OWExplainPredictions(OWWidget):
     gui_error = settings.Setting(0.05)
     gui_p_val = settings.Setting(0.05)
     gui_num_atr = settings.Setting(20)
+    gui_sampling = settings.Setting(0)
+    gui_stratified = settings.Setting(False)
+    gui_n_jobs = settings.Setting(1)
     sort_index = settings.Setting(SortBy.ABSOLUTE)
 
     class Inputs:
@@ -252,9 +963,6 @@ class OWExplainPredictions(OWWidget):
     class Outputs:
         explanations = Output("Explanations", Table)
 
-    class Error(OWWidget.Error):
-        sample_too_big = widget.Msg("Can only explain one sample at the time.")
-
     class Warning(OWWidget.Warning):
         unknowns_increased = widget.Msg(
             "Number of unknown values increased, Data and Sample domains mismatch.")
@@ -265,6 +973,7 @@ class OWExplainPredictions(OWWidget):
         self.model = None
         self.to_explain = None
         self.explanations = None
+        self.batch = False
         self.stop = True
         self.e = None
 
@@ -300,6 +1009,20 @@ class OWExplainPredictions(OWWidget):
                                    callback=self._update_p_val_spin,
                                    controlWidth=80, keyboardTracking=False)
 
+        sampling_box = gui.vBox(self.controlArea, "Sampling")
+        self.sampling_combo = gui.comboBox(sampling_box,
+                                           self,
+                                           "gui_sampling",
+                                           label="Coalitions",
+                                           items=["Random", "Antithetic", "Halton", "Sobol"],
+                                           orientation=Qt.Horizontal,
+                                           callback=self._update_sampling)
+        gui.checkBox(sampling_box, self, "gui_stratified", "Stratified background rows",
+                     callback=self._update_sampling)
+        gui.spin(sampling_box, self, "gui_n_jobs", 1, multiprocessing.cpu_count(),
+                 label="Processes", callback=self._update_sampling, controlWidth=80,
+                 keyboardTracking=False)
+
         plot_properties_box = gui.vBox(self.controlArea, "Display features")
         self.num_atr_spin = gui.spin(plot_properties_box,
                                      self,
@@ -400,7 +1123,7 @@ class OWExplainPredictions(OWWidget):
         self.box_scene.clear()
         wp = self.box_view.viewport().rect()
         header_height = 30
-        if self.explanations is not None:
+        if self.explanations is not None and not self.batch:
             self.painter = GraphAttributes(self.box_scene, min(
                 self.gui_num_atr, self.explanations.Y.shape[0]))
             self.painter.paint(wp, self.explanations, header_h=header_height)
@@ -445,7 +1168,7 @@ class OWExplainPredictions(OWWidget):
         self.data = data
         self.explanations = None
         self.data_info.setText("Data: N/A")
-        self.e = None
+        self._close_explainer()
         if data is not None:
             model = TableModel(data, parent=None)
             if data.X.shape[0] == 1:
@@ -464,30 +1187,27 @@ class OWExplainPredictions(OWWidget):
         self.model = model
         self.model_info.setText("Model: N/A")
         self.explanations = None
-        self.e = None
+        self._close_explainer()
         if model is not None:
             self.model_info.setText("Model: " + str(model.name))
 
     @Inputs.sample
     @check_sql_input
     def set_sample(self, sample):
-        """Set input 'Sample', checks if size is appropriate"""
+        """Set input 'Sample'; samples with more than one instance are explained together"""
         self.to_explain = sample
         self.explanations = None
-        self.Error.sample_too_big.clear()
         self.sample_info.setText("Sample: N/A")
         if sample is not None:
-            if len(sample.X) != 1:
-                self.to_explain = None
-                self.Error.sample_too_big()
+            if sample.X.shape[1] == 1:
+                feat = "1 feature"
             else:
-                if sample.X.shape[1] == 1:
-                    feat = "1 feature"
-                else:
-                    feat = str(sample.X.shape[1]) + " features"
-                self.sample_info.setText("Sample: " + feat)
-                if self.e is not None:
-                    self.e.saved = False
+                feat = str(sample.X.shape[1]) + " features"
+            if len(sample.X) > 1:
+                feat = str(len(sample.X)) + " instances and " + feat
+            self.sample_info.setText("Sample: " + feat)
+            if self.e is not None:
+                self.e.saved = False
 
     def handleNewSignals(self):
         if self._task is not None:
@@ -507,10 +1227,14 @@ class OWExplainPredictions(OWWidget):
             self.commit_output()
 
     def commit_calc(self):
-        num_nan = np.count_nonzero(np.isnan(self.to_explain.X[0]))
-
-        self.to_explain = self.to_explain.transform(self.data.domain)
-        if num_nan != np.count_nonzero(np.isnan(self.to_explain.X[0])):
+        num_nan = np.count_nonzero(np.isnan(self.to_explain.X))
+
+        # the sample's metas are passed on to the explanations of a batch
+        self.to_explain = self.to_explain.transform(
+            Domain(self.data.domain.attributes, self.data.domain.class_vars,
+                   self.to_explain.domain.metas))
+        self.batch = len(self.to_explain) > 1
+        if num_nan != np.count_nonzero(np.isnan(self.to_explain.X)):
             self.Warning.unknowns_increased()
         if self.model is not None:
             # calculate contributions
@@ -520,7 +1244,10 @@ class OWExplainPredictions(OWWidget):
                                             batch_size=min(
                                                 len(self.data.X), 500),
                                             p_val=self.gui_p_val,
-                                            error=self.gui_error)
+                                            error=self.gui_error,
+                                            sampling=SAMPLING[self.gui_sampling],
+                                            stratified=self.gui_stratified,
+                                            n_jobs=self.gui_n_jobs)
             self._task = task = Task()
 
             def callback(progress):
@@ -541,8 +1268,12 @@ class OWExplainPredictions(OWWidget):
                     self, "update_model_prediction", Qt.QueuedConnection, Q_ARG(float, class_value))
 
             self.was_canceled = False
-            explain_func = partial(
-                self.e.anytime_explain, self.to_explain[0], callback=callback, update_func=callback_update, update_prediction=callback_prediction)
+            if self.batch:
+                explain_func = partial(
+                    self.e.explain_batch, self.to_explain, callback=callback)
+            else:
+                explain_func = partial(
+                    self.e.anytime_explain, self.to_explain[0], callback=callback, update_func=callback_update, update_prediction=callback_prediction)
 
             self.progressBarInit(processEvents=None)
             task.future = self._executor.submit(explain_func)
@@ -553,7 +1284,8 @@ class OWExplainPredictions(OWWidget):
     @pyqtSlot(Orange.data.Table)
     def update_view(self, table):
         self.explanations = table
-        self.sort_explanations()
+        if not self.batch:
+            self.sort_explanations()
         self.draw()
         self.commit_output()
 
@@ -589,9 +1321,6 @@ class OWExplainPredictions(OWWidget):
             log = logging.getLogger()
             log.exception(__name__, exc_info=True)
             self.error("Exception occured during evaluation: {!r}".format(ex))
-
-            for key in self.results.keys():
-                self.results[key] = None
         else:
             self.update_view(results[1])
 
@@ -651,18 +1380,33 @@ class OWExplainPredictions(OWWidget):
             self.e.p_val = self.gui_p_val
         self.handleNewSignals()
 
+    def _update_sampling(self):
+        self.cancel()
+        if self.e is not None:
+            self.e.sampling = SAMPLING[self.gui_sampling]
+            self.e.stratified = self.gui_stratified
+            self.e.n_jobs = self.gui_n_jobs
+        self.handleNewSignals()
+
     def _update_num_atr_spin(self):
         self.cancel()
         self.handleNewSignals()
 
     def _update_combo(self):
-        if self.explanations != None:
+        if self.explanations != None and not self.batch:
             self.sort_explanations()
             self.draw()
             self.commit_output()
 
-    def onDeleteWidget(self):
+    def _close_explainer(self):
+        """Stops the computation and the explainer's worker processes"""
         self.cancel()
+        if self.e is not None:
+            self.e.close()
+            self.e = None
+
+    def onDeleteWidget(self):
+        self._close_explainer()
         super().onDeleteWidget()
 
 
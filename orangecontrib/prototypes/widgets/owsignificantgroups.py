@@ -1,3 +1,4 @@
+import os
 import concurrent.futures
 import logging
 from collections import OrderedDict
@@ -14,6 +15,7 @@ from AnyQt.QtCore import Qt, QThread, Slot
 
 from Orange.data import Table, DiscreteVariable
 from Orange.data.filter import FilterDiscrete, Values
+from Orange.misc.environ import cache_dir
 from Orange.widgets import widget, settings, gui
 from Orange.widgets.utils.annotated_data import create_annotated_table
 from Orange.widgets.utils.itemmodels import PyTableModel, DomainModel
@@ -25,7 +27,7 @@ from orangecontrib.prototypes.significance import (
     perm_test, hyper_test, chi2_test, t_test,
     fligner_killeen_test, mannwhitneyu_test,
     gumbel_min_test, gumbel_max_test,
-    CORRECTED_LABEL,
+    NullDistributionCache, CORRECTIONS, PVALUE_LABEL,
 )
 from orangecontrib.prototypes.pandas_util import table_from_frame
 
@@ -59,28 +61,42 @@ class OWSignificantGroups(widget.OWWidget):
         no_vars_selected = widget.Msg('No independent variables selected')
         no_class_selected = widget.Msg('No dependent variable selected')
 
+    # Maps displayed statistic names to perm_test statistics
     TEST_STATISTICS = OrderedDict((
-        ('mean', np.nanmean),
-        ('variance', np.nanvar),
-        ('median', np.nanmedian),
-        ('minimum', np.nanmin),
-        ('maximum', np.nanmax),
+        ('mean', 'mean'),
+        ('variance', 'var'),
+        ('median', 'median'),
+        ('minimum', 'min'),
+        ('maximum', 'max'),
     ))
 
+    PROCESSES_MIN_ROWS = 500000
+
     settingsHandler = settings.DomainContextHandler()
 
     chosen_X = settings.ContextSetting([])
     chosen_y = settings.ContextSetting(0)
     is_permutation = settings.Setting(False)
+    use_null_cache = settings.Setting(False)
     test_statistic = settings.Setting(next(iter(TEST_STATISTICS)))
     min_count = settings.Setting(20)
+    correction = settings.Setting(next(iter(CORRECTIONS)))
+    cutoff = settings.Setting(.2)
 
     def __init__(self):
         self._task = None  # type: Optional[self.Task]
+        # Cancelled tasks that are still running, until they abort
+        self._cancelled_tasks = set()
         self._executor = ThreadExecutor(self)
+        self._null_cache = NullDistributionCache(
+            os.path.join(cache_dir(), 'significant-groups'))
 
         self.data = None
         self.test_type = ''
+        # Unfiltered results of computed tests on current data,
+        # keyed by grouping variables, test variable and test
+        self._results = {}
+        self._result = None
 
         self.discrete_model = DomainModel(separators=False, valid_types=(DiscreteVariable,), parent=self)
         self.domain_model = DomainModel(valid_types=DomainModel.PRIMITIVE, parent=self)
@@ -100,6 +116,13 @@ class OWSignificantGroups(widget.OWWidget):
 
         gui.checkBox(box, self, 'is_permutation', label='Permutation test',
                      callback=self.set_test_type)
+        cache_box = gui.hBox(box)
+        gui.checkBox(cache_box, self, 'use_null_cache',
+                     label='Cache null distributions',
+                     toolTip='Store null distributions of permutation tests on '
+                             'disk, so repeated tests on the same data are faster.')
+        gui.button(cache_box, self, 'Clear', callback=self.clear_null_cache,
+                   autoDefault=False, toolTip='Remove stored null distributions.')
         gui.comboBox(box, self, 'test_statistic', label='Statistic:',
                      items=tuple(self.TEST_STATISTICS),
                      orientation=Qt.Horizontal,
@@ -109,7 +132,16 @@ class OWSignificantGroups(widget.OWWidget):
 
         box = gui.vBox(self.controlArea, 'Filter')
         gui.spin(box, self, 'min_count', 5, 1000, 5,
-                 label='Minimum group size (count):')
+                 label='Minimum group size (count):',
+                 callback=self.show_results)
+        gui.comboBox(box, self, 'correction', label='Correction:',
+                     items=tuple(CORRECTIONS),
+                     orientation=Qt.Horizontal,
+                     sendSelectedValue=True,
+                     callback=self.show_results)
+        gui.doubleSpin(box, self, 'cutoff', .01, 1, .01,
+                       label='Corrected p-value below:',
+                       callback=self.show_results)
 
         self.btn_compute = gui.button(self.controlArea, self, '&Compute', callback=self.compute)
         gui.rubber(self.controlArea)
@@ -170,7 +202,10 @@ class OWSignificantGroups(widget.OWWidget):
 
     @Inputs.data
     def set_data(self, data):
+        self.cancel()
         self.data = data
+        self._results = {}
+        self._result = None
         domain = None if data is None else data.domain
 
         self.closeContext()
@@ -231,6 +266,13 @@ class OWSignificantGroups(widget.OWWidget):
         if not isinstance(self.chosen_X, (list, tuple)):
             self.chosen_X = [self.chosen_X]
 
+        self.cancel()
+        key = self._result_key()
+        if key in self._results:
+            self._result = self._results[key]
+            self.show_results()
+            return
+
         self.btn_compute.setEnabled(False)
         yvar = self.data.domain[self.chosen_y]
 
@@ -246,13 +288,27 @@ class OWSignificantGroups(widget.OWWidget):
         X = pd.DataFrame(X, columns=self.chosen_X)
         y = pd.Series(self.data.get_column_view(yvar)[0])
 
-        test, args, kwargs = None, (X, y), dict(min_count=self.min_count)
+        # The task serves as the computation's cancellation token. All
+        # groups are kept, so that filters apply without recomputation.
+        self._task = task = self.Task()
+        task.key = key
+        set_progress = methodinvoke(self, "setProgressValue", (int, int))
+
+        def callback(n, N):
+            # Progress of a cancelled task would show in the next one's bar
+            if not task.cancelled:
+                set_progress(n, N)
+
+        test, args, kwargs = None, (X, y), dict(
+            min_count=1, cancel_token=task, callback=callback)
         if self.is_permutation:
             statistic = 'chi2' if yvar.is_discrete else self.TEST_STATISTICS[self.test_statistic]
             test = perm_test
             kwargs.update(
-                statistic=statistic, n_jobs=-2,
-                callback=methodinvoke(self, "setProgressValue", (int, int)))
+                statistic=statistic, n_jobs=-2, sampling='nested',
+                # Worker processes only pay off their start-up on large data
+                backend='processes' if len(y) >= self.PROCESSES_MIN_ROWS else 'threading',
+                seed=0, null_cache=self._null_cache if self.use_null_cache else None)
         else:
             if yvar.is_discrete:
                 if len(yvar.values) > 2:
@@ -269,7 +325,6 @@ class OWSignificantGroups(widget.OWWidget):
                     'maximum': gumbel_max_test,
                 }[self.test_statistic]
 
-        self._task = task = self.Task()
         self.progressBarInit()
         task.future = self._executor.submit(test, *args, **kwargs)
         task.watcher = FutureWatcher(task.future)
@@ -284,26 +339,64 @@ class OWSignificantGroups(widget.OWWidget):
         future = ...  # type: concurrent.futures.Future
         watcher = ...  # type: FutureWatcher
         cancelled = False  # type: bool
+        key = None  # type: tuple
 
         def cancel(self):
+            # Running tests check this flag between batches and abort
             self.cancelled = True
             # Cancel the future. Note this succeeds only if the execution has
-            # not yet started (see `concurrent.futures.Future.cancel`) ..
+            # not yet started (see `concurrent.futures.Future.cancel`)
             self.future.cancel()
-            # ... and wait until computation finishes
-            concurrent.futures.wait([self.future])
+
+    def cancel(self):
+        """Cancel the current task (if any) without waiting for it to abort;
+        the task is released when its watcher reports it done"""
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.watcher.done.disconnect(self.on_computed)
+            task.cancel()
+            self._cancelled_tasks.add(task)
+            task.watcher.done.connect(
+                lambda _, task=task: self._cancelled_tasks.discard(task))
+            self.progressBarFinished()
+            self.btn_compute.setEnabled(True)
+
+    def clear_null_cache(self):
+        self._null_cache.clear()
+
+    def onDeleteWidget(self):
+        self.cancel()
+        super().onDeleteWidget()
 
     @Slot(concurrent.futures.Future)
     def on_computed(self, future):
         assert self.thread() is QThread.currentThread()
         assert future.done()
 
+        key = self._task.key
         self._task = None
         self.progressBarFinished()
+        self.btn_compute.setEnabled(True)
+
+        self._results[key] = self._result = future.result()
+        self.show_results()
 
-        df = future.result()
+    def _result_key(self):
+        return (tuple(self.chosen_X), self.chosen_y, self.is_permutation,
+                self.test_statistic)
+
+    def show_results(self):
+        """Filter and correct the current result and show it"""
+        if self._result is None:
+            return
+        df = self._result
+        df = df[df['count'] >= self.min_count].drop(
+            columns=[col for col in df.columns if col.startswith('Corrected')])
+        corrected_label = 'Corrected p-value ({})'.format(self.correction)
+        df[corrected_label] = CORRECTIONS[self.correction](
+            df[PVALUE_LABEL], df.attrs.get('n_tests'))
         # Only retain "significant" p-values
-        df = df[df[CORRECTED_LABEL] < .2]
+        df = df[df[corrected_label] < self.cutoff]
 
         columns = [var.name for var in df.index.name] + list(df.columns)
         lst = [list(i) + list(j)
@@ -320,13 +413,14 @@ class OWSignificantGroups(widget.OWWidget):
         self.view.sortByColumn(len(columns) - 1, Qt.AscendingOrder)
 
         self.Information.nothing_significant(shown=not lst)
-        self.btn_compute.setEnabled(True)
 
     def send_report(self):
         self.report_items([
             ('Test Variable', self.chosen_y),
             ('Test', self.test_type),
             ('Min. group size', self.min_count),
+            ('Correction', self.correction),
+            ('Corrected p-value below', self.cutoff),
         ])
         self.report_table('Significant Groups', self.view)
 
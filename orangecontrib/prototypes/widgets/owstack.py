@@ -2,11 +2,12 @@ from collections import OrderedDict
 
 from Orange.data import Table
 from Orange.base import Learner
+from Orange.widgets import gui
 from Orange.widgets.settings import Setting
 from Orange.widgets.utils.owlearnerwidget import OWBaseLearner
-from Orange.widgets.widget import Msg, Input
+from Orange.widgets.widget import Msg, Input, Output
 
-from orangecontrib.prototypes.stack import StackedFitter
+from orangecontrib.prototypes.stack import StackedFitter, BaseFitCache
 
 
 class OWStackedLearner(OWBaseLearner):
@@ -18,18 +19,49 @@ class OWStackedLearner(OWBaseLearner):
     LEARNER = StackedFitter
 
     learner_name = Setting("Stack")
+    blending = Setting(False)
+    k = Setting(5)
+    holdout = Setting(20)
+    refit = Setting(True)
+    # Meta-features are a copy of training data's class and metas, which
+    # is only kept in the model if they are output
+    output_meta_features = Setting(True)
 
     class Inputs(OWBaseLearner.Inputs):
         learners = Input("Learners", Learner, multiple=True)
         aggregate = Input("Aggregate", Learner)
 
+    class Outputs(OWBaseLearner.Outputs):
+        meta_features = Output("Meta-features", Table)
+
     def __init__(self):
         self.learners = OrderedDict()
         self.aggregate = None
+        # Base learners' fits are reused when only the aggregator changes
+        self.cache = BaseFitCache()
         super().__init__()
 
     def add_main_layout(self):
-        pass
+        box = gui.radioButtons(self.controlArea, self, 'blending',
+                               box='Aggregator Training Data',
+                               callback=self.settings_changed)
+        gui.appendRadioButton(box, 'Cross-validation')
+        gui.spin(gui.indentedBox(box), self, 'k', 2, 20,
+                 label='Number of folds:', callback=self.settings_changed)
+        gui.appendRadioButton(box, 'Holdout (blending)')
+        gui.spin(gui.indentedBox(box), self, 'holdout', 5, 50, 5,
+                 label='Holdout size (%):', callback=self.settings_changed)
+        gui.checkBox(box, self, 'refit', 'Refit base models on all data',
+                     callback=self.settings_changed)
+        gui.checkBox(self.controlArea, self, 'output_meta_features',
+                     'Output meta-features', box='Output',
+                     callback=self.settings_changed)
+
+    @OWBaseLearner.Inputs.data
+    def set_data(self, data):
+        # Base learners' fits on previous data won't be reused
+        self.cache.clear()
+        super().set_data(data)
 
     @Inputs.learners
     def set_learners(self, learner, id):
@@ -47,14 +79,30 @@ class OWStackedLearner(OWBaseLearner):
     def create_learner(self):
         if not self.learners:
             return None
+        kwargs = {} if self.aggregate is None else dict(aggregate=self.aggregate)
         return self.LEARNER(
-            tuple(self.learners.values()), aggregate=self.aggregate,
-            preprocessors=self.preprocessors)
+            tuple(self.learners.values()),
+            k=self.k, holdout=self.holdout / 100 if self.blending else None,
+            refit=self.refit, cache=self.cache, preprocessors=self.preprocessors,
+            keep_meta_data=self.output_meta_features, **kwargs)
+
+    def update_model(self):
+        super().update_model()
+        # Out-of-fold predictions of base learners, e.g. for stacking them
+        # with another Stacking widget without refitting the base learners
+        self.Outputs.meta_features.send(
+            self.model.meta_data
+            if self.model is not None and self.output_meta_features else None)
 
     def get_learner_parameters(self):
         return (("Base learners", [l.name for l in self.learners.values()]),
                 ("Aggregator",
-                 self.aggregate.name if self.aggregate else 'default'))
+                 self.aggregate.name if self.aggregate else 'default'),
+                ("Aggregator training data",
+                 "{}% holdout".format(self.holdout) if self.blending else
+                 "{}-fold cross-validation".format(self.k)),
+                ("Refit base models", self.refit),
+                ("Output meta-features", self.output_meta_features))
 
 
 if __name__ == "__main__":
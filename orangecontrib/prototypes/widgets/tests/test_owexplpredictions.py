@@ -0,0 +1,283 @@
+# Test methods with long descriptive names can omit docstrings
+# pylint: disable=missing-docstring
+import copy
+import itertools
+import unittest
+from functools import partial
+from unittest.mock import patch
+
+import numpy as np
+from numpy.random import RandomState
+
+from Orange.data import Table, Domain, ContinuousVariable, StringVariable
+from Orange.classification import LogisticRegressionLearner, TreeLearner, SklTreeLearner, \
+    KNNLearner
+from Orange.regression import LinearRegressionLearner, RandomForestRegressionLearner, \
+    SklTreeRegressionLearner, TreeLearner as TreeRegressionLearner
+from Orange.widgets.tests.base import WidgetTest
+from orangecontrib.prototypes.widgets import owexplpredictions
+from orangecontrib.prototypes.widgets.owexplpredictions import ExplainPredictions, \
+    OWExplainPredictions
+
+
+class TestExplainPredictions(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.iris = Table("iris")
+
+    def _baseline_diffs(self, e, inst_x, class_value, atrs):
+        """Differences computed as before predictions were fused: draws are taken from the seeded
+        generator in place and both halves are predicted with separate calls on tables"""
+        prng = RandomState(e.seed)
+        data_rows, no_atr = e.data.X.shape
+        tiled_inst = Table.from_numpy(e.data.domain, np.tile(inst_x, (e.batch_size, 1)),
+                                      np.zeros((e.batch_size, 1)))
+        inst1 = copy.deepcopy(tiled_inst)
+        inst2 = copy.deepcopy(tiled_inst)
+        diffs = []
+        for a in atrs:
+            perm = (prng.random_sample(e.batch_size * no_atr).reshape(
+                e.batch_size, no_atr)) > 0.5
+            rand_data = e.data.X[prng.randint(0, data_rows, size=e.batch_size), :]
+            with inst1.unlocked(), inst2.unlocked():
+                inst1.X = np.copy(tiled_inst.X)
+                inst1.X[perm] = rand_data[perm]
+                inst2.X = np.copy(inst1.X)
+                inst1.X[:, a] = tiled_inst.X[:, a]
+                inst2.X[:, a] = rand_data[:, a]
+            f1 = e._get_predictions(inst1, class_value)
+            f2 = e._get_predictions(inst2, class_value)
+            diffs.append(np.sum(f1 - f2))
+        return diffs
+
+    def test_fused_predictions_match_baseline(self):
+        atrs = [0, 2, 3, 1, 2]
+        for learner in (TreeLearner(), LogisticRegressionLearner()):
+            model = learner(self.iris)
+            e = ExplainPredictions(self.iris, model, batch_size=50, exact=False)
+            inst_x = self.iris.X[60]
+            class_value = np.atleast_1d(model(self.iris[60]))[0]
+            draws = e.draws(RandomState(e.seed))
+            X, inst = e.prediction_buffer(2 * e.batch_size)
+            diffs = [e.sample_step(inst_x, class_value, a, draws, X, inst) for a in atrs]
+            self.assertTrue(np.any(diffs))
+            np.testing.assert_array_equal(
+                diffs, self._baseline_diffs(e, inst_x, class_value, atrs))
+
+    @staticmethod
+    def _binary_data(y_func, n=64):
+        X = RandomState(0).randint(0, 2, (n, 3)).astype(float)
+        domain = Domain([ContinuousVariable(name) for name in "abc"], ContinuousVariable("y"))
+        return Table.from_numpy(domain, X, y_func(X))
+
+    def _explained_rows(self, data, model, **kwargs):
+        e = ExplainPredictions(data, model, batch_size=64, error=0.03, min_iter=128, exact=False,
+                               **kwargs)
+        instance = Table.from_numpy(data.domain, np.ones((1, 3)), np.zeros(1))[0]
+        _, table = e.anytime_explain(instance, callback=lambda _: False,
+                                     update_func=lambda _: None)
+        return table, e.steps.sum()
+
+    def test_coalition_sampling_reduces_rows(self):
+        data = self._binary_data(lambda X: X[:, 0] * X[:, 1] + X[:, 2])
+        model = TreeRegressionLearner()(data)
+        # with a single background row, the variance is due to coalitions only
+        background = Table.from_numpy(data.domain, np.zeros((64, 3)), np.zeros(64))
+        table, random_rows = self._explained_rows(background, model)
+        np.testing.assert_allclose(table.X[:, 0], [0.5, 0.5, 1], atol=0.1)
+        for sampling in ("antithetic", "sobol"):
+            table, rows = self._explained_rows(background, model, sampling=sampling)
+            # complementary or balanced coalitions estimate the interaction without error
+            np.testing.assert_allclose(table.X[:, 0], [0.5, 0.5, 1])
+            self.assertLess(rows, random_rows)
+
+    def test_stratified_rows_reduce_rows(self):
+        data = self._binary_data(lambda X: X.sum(axis=1))
+        model = TreeRegressionLearner()(data)
+        # the model is additive, so the variance is due to background rows only
+        table, random_rows = self._explained_rows(data, model)
+        table, rows = self._explained_rows(data, model, stratified=True)
+        # each batch includes each row once
+        np.testing.assert_allclose(table.X[:, 0], 1 - data.X.mean(axis=0))
+        self.assertLess(rows, random_rows)
+
+    def test_explain_batch(self):
+        housing = Table("housing")
+        model = LinearRegressionLearner()(housing)
+        domain = Domain(housing.domain.attributes, housing.domain.class_var,
+                        [StringVariable("name")])
+        instances = housing[[3, 100, 400]].transform(domain)
+        with instances.unlocked(instances.metas):
+            instances.metas[:, 0] = ["a", "b", "c"]
+        e = ExplainPredictions(housing, model, batch_size=50, error=0.5, exact=False)
+        class_values, table = e.explain_batch(instances, chunk_size=2)
+
+        np.testing.assert_allclose(class_values, model(instances))
+        np.testing.assert_array_equal(table.ids, instances.ids)
+        self.assertEqual(table.domain.metas[-1].name, "name")
+        np.testing.assert_array_equal(table.metas[:, -1], ["a", "b", "c"])
+        errors = table.metas[:, :-1].astype(float)
+        self.assertTrue(np.all(errors < 0.5))
+        exact, _ = ExplainPredictions(housing, model).exact_contributions(
+            instances.X, class_values)
+        np.testing.assert_array_less(np.abs(table.X - exact), 2 * errors + 1e-9)
+
+    @staticmethod
+    def _brute_force(e, x, class_value):
+        """Averages differences over all background rows and coalitions of other attributes"""
+        data = e.data
+        n_rows, no_atr = data.X.shape
+        domain = Domain(data.domain.attributes, data.domain.class_vars)
+        contributions = np.zeros(no_atr)
+        for a in range(no_atr):
+            others = [atr for atr in range(no_atr) if atr != a]
+            for mask in itertools.product((False, True), repeat=no_atr - 1):
+                replaced = [atr for atr, from_row in zip(others, mask) if from_row]
+                X1 = np.tile(x, (n_rows, 1))
+                X1[:, replaced] = data.X[:, replaced]
+                X2 = X1.copy()
+                X2[:, a] = data.X[:, a]
+                inst = Table.from_numpy(domain, np.vstack((X1, X2)), np.full(2 * n_rows, np.nan))
+                f = e._get_predictions(inst, class_value)
+                contributions[a] += np.sum(f[:n_rows]) - np.sum(f[n_rows:])
+        return contributions / (n_rows * 2 ** (no_atr - 1))
+
+    def _assert_exact(self, data, model, rows):
+        e = ExplainPredictions(data, model)
+        class_values = model(data[rows])
+        contributions, errors = e.exact_contributions(data.X[rows], class_values)
+        np.testing.assert_array_equal(errors, 0)
+        for i, row in enumerate(rows):
+            np.testing.assert_allclose(
+                contributions[i], self._brute_force(e, data.X[row], class_values[i]),
+                atol=1e-10)
+
+    def test_exact_linear(self):
+        housing = Table("housing")
+        data = housing.transform(Domain(housing.domain.attributes[:5], housing.domain.class_var))
+        data = data[:40]
+        self._assert_exact(data, LinearRegressionLearner()(data), [0, 7])
+
+    def test_exact_trees(self):
+        data = self.iris[::3]
+        for learner in (TreeLearner(), SklTreeLearner()):
+            self._assert_exact(data, learner(data), [0, 20, 40])
+
+        # discrete attributes and missing values
+        heart = Table("heart_disease")
+        data = heart.transform(Domain(heart.domain.attributes[:6], heart.domain.class_var))
+        data = data[:60].copy()
+        with data.unlocked(data.X):
+            data.X[::7, 2] = np.nan
+        self._assert_exact(data, TreeLearner()(data), [0, 7, 30])
+
+    def test_exact_forest(self):
+        housing = Table("housing")
+        data = housing.transform(Domain(housing.domain.attributes[:5], housing.domain.class_var))
+        data = data[:60].copy()
+        with data.unlocked(data.X):
+            data.X[::5, 1] = np.nan
+        model = RandomForestRegressionLearner(n_estimators=10, random_state=0)(data)
+        # attributes with imputed values are mapped to the data's attributes
+        self.assertNotEqual(model.domain.attributes, data.domain.attributes)
+        self._assert_exact(data, model, [0, 5, 33])
+
+    def test_exact_subsampled_reference(self):
+        housing = Table("housing")
+        model = RandomForestRegressionLearner(n_estimators=10, random_state=0)(housing)
+        class_values = model(housing[:5])
+        # all rows are used by default
+        all_rows, errors = ExplainPredictions(housing, model).exact_contributions(
+            housing.X[:5], class_values)
+        np.testing.assert_array_equal(errors, 0)
+
+        e = ExplainPredictions(housing, model, reference_rows=100)
+        contributions, errors = e.exact_contributions(housing.X[:5], class_values)
+        self.assertTrue(np.all(errors > 0))
+        np.testing.assert_array_less(np.abs(contributions - all_rows), 2 * errors + 1e-9)
+
+    def test_exact_reference_of_model(self):
+        housing = Table("housing")
+        data = housing.transform(Domain(housing.domain.attributes[:5], housing.domain.class_var))
+        models = [RandomForestRegressionLearner(n_estimators=5, random_state=seed)(data)
+                  for seed in (0, 1)]
+        e = ExplainPredictions(data, models[0])
+        e.exact_contributions(data.X[:3], models[0](data[:3]))
+        # agreement with the former model's trees isn't reused
+        e.model = models[1]
+        contributions, _ = e.exact_contributions(data.X[:3], models[1](data[:3]))
+        expected, _ = ExplainPredictions(data, models[1]).exact_contributions(
+            data.X[:3], models[1](data[:3]))
+        np.testing.assert_array_equal(contributions, expected)
+
+    def test_exact_large_tree(self):
+        prng = RandomState(0)
+        X = prng.normal(size=(20000, 10))
+        y = X @ prng.normal(size=10) + prng.normal(size=20000)
+        domain = Domain([ContinuousVariable(f"x{i}") for i in range(10)],
+                        ContinuousVariable("y"))
+        data = Table.from_numpy(domain, X, y)
+        model = SklTreeRegressionLearner()(data)
+        e = ExplainPredictions(data, model)
+        contributions, errors = e.exact_contributions(X[:50], model(data[:50]))
+        # the tree is too large for all rows; the default number of rows is bounded
+        reference = e._reference
+        self.assertLess(reference.n_rows, len(data))
+        self.assertLessEqual(reference.tables.size, owexplpredictions._MAX_TREE_TABLES)
+        self.assertTrue(np.all(errors > 0))
+        self.assertLess(np.median(errors), 0.2)
+        # contributions of larger coefficients are larger
+        coefficients = np.abs(model(data) @ X / len(X))
+        self.assertEqual(np.argmax(np.abs(contributions).mean(axis=0)),
+                         np.argmax(coefficients))
+
+        with patch.object(owexplpredictions, "_MAX_TREE_TABLES", 10000):
+            e = ExplainPredictions(data, model)
+            self.assertIsNone(e.exact_contributions(X[:5], model(data[:5])))
+
+    def test_parallel(self):
+        model = TreeLearner()(self.iris)
+        sequential = ExplainPredictions(self.iris, model, batch_size=100, exact=False)
+        parallel = ExplainPredictions(self.iris, model, batch_size=100, exact=False, n_jobs=2)
+        self.addCleanup(parallel.close)
+
+        explain = partial(ExplainPredictions.anytime_explain, instance=self.iris[60],
+                          callback=lambda _: False, update_func=lambda _: None)
+        single = explain(sequential)[1]
+        batch = sequential.explain_batch(self.iris[::10])[1]
+        par_single = explain(parallel)[1]
+        pool = parallel._executor
+        par_batch = parallel.explain_batch(self.iris[::10])[1]
+        # the workers are started once per explainer
+        self.assertIs(parallel._executor, pool)
+
+        np.testing.assert_array_less(np.abs(single.X[:, 0] - par_single.X[:, 0]),
+                                     single.X[:, 1] + par_single.X[:, 1] + 1e-9)
+        np.testing.assert_array_less(np.abs(batch.X - par_batch.X),
+                                     batch.metas + par_batch.metas + 1e-9)
+
+
+class TestOWExplainPredictions(WidgetTest):
+    def setUp(self):
+        self.widget = self.create_widget(OWExplainPredictions)
+
+    def test_explain_sample(self):
+        heart = Table("heart_disease")
+        data = heart.transform(Domain(heart.domain.attributes[:5], heart.domain.class_var))
+        data = data[:60]
+        # the model's domain is continuized, so predicted rows are put in a table
+        model = KNNLearner()(data)
+        self.assertNotEqual(model.domain.attributes, data.domain.attributes)
+        self.widget.gui_error = 0.2
+        self.send_signal(self.widget.Inputs.data, data)
+        self.send_signal(self.widget.Inputs.model, model)
+        self.send_signal(self.widget.Inputs.sample, data[:3])
+        self.process_events(lambda: self.widget._task is None, timeout=60000)
+        output = self.get_output(self.widget.Outputs.explanations)
+        self.assertEqual(len(output), 3)
+        np.testing.assert_array_equal(output.ids, data.ids[:3])
+        self.widget.onDeleteWidget()
+
+
+if __name__ == "__main__":
+    unittest.main()